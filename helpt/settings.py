@@ -184,6 +184,45 @@ DYNAMIC_REST = {
     'ENABLE_BULK_UPDATE': False,
 }
 
+# HTTP connections used by the workspace sync adapters
+#
+# Maximum number of pooled keep-alive connections per API host
+SYNC_HTTP_POOL_SIZE = 10
+# (connect, read) timeouts in seconds for API requests
+SYNC_HTTP_TIMEOUT = (5, 60)
+# Number of times a failed or rate limited request is retried. Only GET
+# requests are retried after connection errors and server errors.
+SYNC_HTTP_RETRIES = 3
+# Maximum delay in seconds before the first retry of a failed request,
+# doubled on each further attempt up to SYNC_HTTP_RETRY_MAX_DELAY
+SYNC_HTTP_RETRY_DELAY = 1
+SYNC_HTTP_RETRY_MAX_DELAY = 30
+# Syncs fail instead of waiting longer than this many seconds for a rate
+# limit to allow the next request
+SYNC_RATE_LIMIT_MAX_WAIT = 300
+# Number of requests reserved from the shared rate limit at a time
+SYNC_RATE_LIMIT_BATCH_SIZE = 10
+# Cached API responses not used for this many seconds are deleted when
+# the tasks of their data source are synced
+SYNC_HTTP_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# Background sync jobs
+#
+# Number of times a failed job is tried before giving up
+SYNC_JOB_MAX_ATTEMPTS = 5
+# Delay in seconds before the first retry, doubled on each further attempt
+SYNC_JOB_RETRY_DELAY = 30
+# Jobs running longer than this many seconds are assumed to be abandoned
+SYNC_JOB_TIMEOUT = 3600
+# New jobs wait this many seconds, so that further requests for the same
+# sync can be merged into them
+SYNC_JOB_DEBOUNCE = 5
+# Number of pending single-task syncs in a workspace that get replaced by
+# one sync of all its tasks
+SYNC_JOB_ESCALATE_THRESHOLD = 10
+# Finished jobs are deleted after this many seconds
+SYNC_JOB_RETENTION = 7 * 24 * 3600
+
 # local_settings.py can be used to override environment-specific settings
 # like database and email that differ between development and production.
 f = os.path.join(BASE_DIR, "local_settings.py")
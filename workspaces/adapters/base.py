@@ -1,22 +1,324 @@
 import datetime
+import functools
+import hashlib
+import json
 import logging
-
-from .sync import ModelSyncher
+import operator
+import random
+import time
+from collections import Counter
+
+import requests
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .bulk import DEFAULT_BATCH_SIZE, bulk_upsert, chunked
+from .metrics import SyncMetrics
+from .ratelimit import RateLimiter
+from .session import get_session
+from .sync import CompactModelSyncher, ModelSyncher
+from .users import DataSourceUserCache, get_shared_user_cache
 
 
 logger = logging.getLogger(__name__)
 
+# Incremental syncs fetch changes starting a bit before the previous
+# sync started to allow for clock skew between us and the remote end.
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+
+# Methods that can safely be retried after a failure
+IDEMPOTENT_METHODS = ('get', 'head')
+# Server errors after which idempotent requests are retried
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+class Checkpoint(object):
+    """
+    Marker placed in a stream of task dicts given to Adapter._update_tasks
+
+    The callback is called once all the tasks before the marker have been
+    written to the database.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __call__(self):
+        self.callback()
+
 
 def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
     return abs(a - b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
 
 
+def fingerprint(data):
+    """
+    Return a stable hash of an imported data dict
+
+    Model instances in the dict are represented by their primary keys and
+    lists of assigned users are sorted, so that the hash only changes when
+    the content does.
+    """
+    normalized = {}
+    for key, value in data.items():
+        if hasattr(value, '_meta'):
+            value = value.pk
+        elif key == 'assigned_users':
+            value = sorted(value)
+        normalized[key] = value
+    encoded = json.dumps(normalized, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha1(encoded.encode('utf8')).hexdigest()
+
+
+class TaskSyncContext(object):
+    """
+    Data needed for syncing the tasks of a workspace
+
+    Everything is loaded up front with a fixed number of queries, so that
+    handling each task needs none.
+
+    :param origin_ids: if given, only the assignments of these tasks are
+        loaded
+    """
+    def __init__(self, workspace, user_cache, origin_ids=None):
+        self.workspace = workspace
+
+        self.user_cache = user_cache
+        self.users_by_id = user_cache.get_users()
+        self.users_reloaded = False
+
+        lists = list(workspace.lists.all())
+        self.lists_by_id = {lst.origin_id: lst for lst in lists}
+        self.lists_by_pk = {lst.id: lst for lst in lists}
+
+        # Tasks inherit the project of the workspace if it has only one
+        projects = list(workspace.projects.all()[:2])
+        self.inherited_project = projects[0] if len(projects) == 1 else None
+
+        # Ids of the users currently assigned to each task of the workspace
+        TaskAssignment = apps.get_model(app_label='workspaces', model_name='TaskAssignment')
+        self.assignments_by_task = {}
+        assignments = TaskAssignment.objects.filter(task__workspace=workspace)
+        if origin_ids is not None:
+            assignments = assignments.filter(task__origin_id__in=origin_ids)
+        for task_id, user_id in assignments.values_list('task_id', 'user_id'):
+            self.assignments_by_task.setdefault(task_id, set()).add(user_id)
+
+    def fingerprint(self, task):
+        """
+        Hash the task dict together with the local settings that affect
+        how it is imported.
+        """
+        data = dict(task)
+        if 'list_origin_id' in task:
+            lst = self.lists_by_id.get(task['list_origin_id'])
+            data['list_task_state'] = lst.task_state if lst else None
+        if 'project' not in task and self.inherited_project:
+            data['project'] = self.inherited_project
+        return fingerprint(data)
+
+    def resolve_assignees(self, task_id, assigned_users):
+        """
+        Map origin ids of assigned users to data source user ids
+        """
+        assignees = set()
+        for user_id in assigned_users:
+            user = self.users_by_id.get(user_id)
+            if not user and not self.users_reloaded:
+                # Users may have been saved while the tasks were being read
+                self.users_by_id = self.user_cache.load()
+                self.users_reloaded = True
+                user = self.users_by_id.get(user_id)
+            if not user:
+                logger.error('Task %s: user with id %s not found' % (task_id, user_id))
+                continue
+            assignees.add(user.id)
+        return assignees
+
+
 class Adapter(object):
+    API_BASE = None
+
     def __init__(self, data_source):
         self.data_source = data_source
+        self._user_cache = None
+        self._rate_limiter = None
+        self.metrics = SyncMetrics()
+
+    @property
+    def user_cache(self):
+        """
+        Cache of the data source's users, shared with other adapters if a
+        multi-workspace sync is running
+        """
+        cache = get_shared_user_cache(self.data_source.pk)
+        if cache is not None:
+            return cache
+        if self._user_cache is None:
+            self._user_cache = DataSourceUserCache(self.data_source.pk)
+        return self._user_cache
+
+    @property
+    def session(self):
+        return get_session(self.API_BASE)
+
+    def get_rate_limit(self):
+        """
+        Return the rate limit of this adapter's API credential
+
+        :returns: tuple of a string identifying the credential, the
+            number of requests allowed per period and the period in
+            seconds, or None if requests are not limited
+        """
+        return None
+
+    @property
+    def rate_limiter(self):
+        if self._rate_limiter is None:
+            limit = self.get_rate_limit()
+            if limit is None:
+                return None
+            credential, capacity, period = limit
+            self._rate_limiter = RateLimiter(self.API_BASE + credential, capacity, period)
+        return self._rate_limiter
+
+    def get_rate_limit_state(self, resp):
+        """
+        Read the rate limit headers of an API response
+
+        :returns: dict of remaining requests, time the limit is reset and
+            seconds to wait before the next request, any of which may be None
+        """
+        headers = resp.headers
+        state = dict(remaining=None, reset_at=None, retry_after=None)
+        if headers.get('X-RateLimit-Remaining', '').isdigit():
+            state['remaining'] = int(headers['X-RateLimit-Remaining'])
+        if headers.get('X-RateLimit-Reset', '').isdigit():
+            state['reset_at'] = datetime.datetime.fromtimestamp(int(headers['X-RateLimit-Reset']),
+                                                                datetime.timezone.utc)
+        if headers.get('Retry-After', '').isdigit():
+            state['retry_after'] = int(headers['Retry-After'])
+        return state
+
+    def is_rate_limited(self, resp, state):
+        """
+        Tell whether the request was rejected because of a rate limit
+        """
+        return resp.status_code == 429
+
+    def _wait_before_retry(self, attempt):
+        """
+        Sleep for a random time up to an exponentially growing maximum, so
+        that parallel workers don't retry in lockstep
+        """
+        max_delay = min(settings.SYNC_HTTP_RETRY_DELAY * 2 ** attempt, settings.SYNC_HTTP_RETRY_MAX_DELAY)
+        time.sleep(random.uniform(0, max_delay))
+
+    def _send_request(self, method, url, **kwargs):
+        """
+        Send a single request, returning the response and the seconds it took
+
+        Nothing here touches the database, so it can be run in any thread.
+        """
+        start = time.monotonic()
+        resp = self.session.request(method, url, **kwargs)
+        return resp, time.monotonic() - start
+
+    def _update_rate_limit(self, resp):
+        """
+        Pass the rate limit state reported in a response to the rate limiter
+
+        :returns: True if the request was rejected because of the rate limit
+        """
+        limiter = self.rate_limiter
+        if limiter is None:
+            return False
+        state = self.get_rate_limit_state(resp)
+        rate_limited = self.is_rate_limited(resp, state)
+        if rate_limited and state['retry_after'] is None and state['reset_at'] is None:
+            state['retry_after'] = 1
+        limiter.update(**state)
+        return rate_limited
+
+    def _complete_request(self, method, url, kwargs, sent=None):
+        """
+        Check the response of a request, retrying the request if needed
+
+        :param sent: future of a first attempt already sent in another thread
+        """
+        limiter = self.rate_limiter
+        retries = settings.SYNC_HTTP_RETRIES
+        idempotent = method.lower() in IDEMPOTENT_METHODS
+        for attempt in range(retries + 1):
+            future, sent = sent, None
+            try:
+                if future is not None:
+                    resp, seconds = future.result()
+                else:
+                    if limiter is not None:
+                        limiter.acquire()
+                    resp, seconds = self._send_request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent or attempt == retries:
+                    raise
+                logger.warning("Request to %s failed (attempt %d): %s" % (url, attempt + 1, e))
+                self._wait_before_retry(attempt)
+                continue
+            self.metrics.add_request(seconds, len(resp.content))
+
+            if self._update_rate_limit(resp):
+                # The limiter waits before the next attempt
+                logger.warning("Request to %s was rate limited (attempt %d)" % (url, attempt + 1))
+                continue
+
+            if idempotent and resp.status_code in RETRY_STATUS_CODES and attempt < retries:
+                logger.warning("Request to %s failed with %d (attempt %d)" % (url, resp.status_code, attempt + 1))
+                self._wait_before_retry(attempt)
+                continue
+            return resp
+        return resp
+
+    def http_request(self, method, url, **kwargs):
+        """
+        Make an HTTP request using the pooled session of this adapter's API
+
+        Requests are paced to stay within the rate limit of the API
+        credential, and retried if the API rejects them for exceeding it.
+        GET requests are also retried after connection and server errors.
+        """
+        kwargs.setdefault('timeout', settings.SYNC_HTTP_TIMEOUT)
+        return self._complete_request(method, url, kwargs)
+
+    def start_request(self, executor, method, url, **kwargs):
+        """
+        Send an HTTP request in a thread of the given executor, so that e.g.
+        the next page of results is fetched while the current one is written
+
+        Only the HTTP exchange happens in the other thread. The request is
+        paced right away, while checking the response and retrying, which
+        may touch the database, are left to the returned function.
+
+        :returns: function returning the response, to be called in this thread
+        """
+        kwargs.setdefault('timeout', settings.SYNC_HTTP_TIMEOUT)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        future = executor.submit(self._send_request, method, url, **kwargs)
+        return functools.partial(self._complete_request, method, url, kwargs, future)
 
     def _set_field(self, obj, field_name, val):
         assert hasattr(obj, field_name)
+        field = obj._meta.get_field(field_name)
+        if field.many_to_one and (val is None or hasattr(val, '_meta')):
+            # Compare related objects by their keys to avoid fetching them
+            if getattr(obj, field.attname) == (val.pk if val is not None else None):
+                return
+            setattr(obj, field_name, val)
+            obj._changed_fields.append(field_name)
+            return
+
         obj_val = getattr(obj, field_name)
         if isinstance(obj_val, datetime.datetime) and isinstance(val, str):
             obj_val = obj_val.isoformat()
@@ -47,38 +349,60 @@ class Adapter(object):
                 continue
             self._set_field(obj, field_name, data[field_name])
 
-    def _update_workspace_lists(self, workspace, lists):
-        def close_list(lst):
-            if lst.state == lst.STATE_CLOSED:
-                return
-            logger.debug("Marking list %s closed" % lst)
-            lst.set_state('closed')
+    def _update_workspace_lists(self, workspace, lists, skip_delete=False):
+        """
+        Synchronizes lists of a workspace based on supplied data dicts
 
+        :param workspace: Workspace the lists belong to
+        :param lists: list of list dicts; only origin_id is required for
+            lists that already exist
+        :param skip_delete: if True, lists missing from `lists` are not closed
+        """
         WorkspaceList = workspace.lists.model
+
+        def close_lists(queryset):
+            # Forget the fingerprints, so that lists reappearing unchanged
+            # are opened again.
+            count = queryset.exclude(state=WorkspaceList.STATE_CLOSED).update(
+                state=WorkspaceList.STATE_CLOSED, fingerprint=None)
+            if count:
+                logger.debug("Marked %d lists of %s closed" % (count, workspace))
+
         syncher = ModelSyncher(workspace.lists.all(),
                                lambda lst: lst.origin_id,
-                               delete_func=close_list,
+                               bulk_delete_func=close_lists,
+                               skip_delete=skip_delete,
                                delete_limit=None)
 
+        new_lists = []
         for lst in lists:
             obj = syncher.get(lst['origin_id'])
             if not obj:
                 obj = WorkspaceList(workspace=workspace, origin_id=lst['origin_id'])
-            for attr_name, value in lst.items():
-                if attr_name == 'state':
-                    continue
-                setattr(obj, attr_name, value)
+            syncher.mark(obj)
+
+            # The default task state affects the list as well
+            fp = fingerprint(dict(lst, default_list_task_state=workspace.default_list_task_state))
+            if obj.id and obj.fingerprint == fp:
+                continue
+
+            if 'state' in lst:
+                assert lst['state'] in [x[0] for x in WorkspaceList.STATES]
+            obj._changed_fields = []
+            self._update_fields(obj, lst)
+            if not obj.task_state and workspace.default_list_task_state:
+                obj.task_state = workspace.default_list_task_state
+                obj._changed_fields.append('task_state')
+            obj.fingerprint = fp
+
             if not obj.id:
                 logger.debug('Creating new workspace list: %s' % obj)
-                created = True
+                new_lists.append(obj)
             else:
-                created = False
-            if not obj.task_state and workspace.default_list_task_state:
-                obj.task_state = workspace.default_list_task_state
-            obj.save()
-            if created and 'state' in lst:
-                obj.set_state(lst['state'])
-            syncher.mark(obj)
+                obj.save(update_fields=obj._changed_fields + ['fingerprint'])
+
+        if new_lists:
+            WorkspaceList.objects.bulk_create(new_lists, batch_size=DEFAULT_BATCH_SIZE)
 
         syncher.finish()
 
@@ -86,11 +410,15 @@ class Adapter(object):
         """
         Synchronizes workspace database based on supplied data dicts
         """
-        def close_workspace(ws):
-            if ws.state == ws.STATE_CLOSED:
-                return
-            logger.debug("Marking workspace %s closed" % ws)
-            ws.set_state('closed')
+        # Get access to model through trickery because otherwise
+        # there would be a circular import.
+        Workspace = self.data_source.workspaces.model
+
+        def close_workspaces(queryset):
+            count = queryset.exclude(state=Workspace.STATE_CLOSED).update(
+                state=Workspace.STATE_CLOSED, fingerprint=None)
+            if count:
+                logger.debug("Marked %d workspaces of %s closed" % (count, self.data_source))
 
         if isinstance(workspace_or_workspaces, dict):
             workspaces = [workspace_or_workspaces]
@@ -99,12 +427,9 @@ class Adapter(object):
             workspaces = workspace_or_workspaces
             skip_delete = False
 
-        # Get access to model through trickery because otherwise
-        # there would be a circular import.
-        Workspace = self.data_source.workspaces.model
         syncher = ModelSyncher(self.data_source.workspaces.all(),
                                lambda ws: ws.origin_id,
-                               delete_func=close_workspace,
+                               bulk_delete_func=close_workspaces,
                                skip_delete=skip_delete,
                                delete_limit=None)
 
@@ -112,138 +437,396 @@ class Adapter(object):
             obj = syncher.get(ws['origin_id'])
             if not obj:
                 obj = Workspace(data_source=self.data_source, origin_id=ws['origin_id'])
-            ws_lists = ws.pop('lists', [])
-            for attr_name, value in ws.items():
-                if attr_name == 'state':
-                    continue
-                setattr(obj, attr_name, value)
-            if not obj.id:
-                logger.info('Creating new workspace: %s' % obj)
-            obj.save()
-            if 'state' in ws:
-                obj.set_state(ws['state'])
-            self._update_workspace_lists(obj, ws_lists)
+            ws_lists = ws.pop('lists', None)
+            fp = fingerprint(ws)
+            if not obj.id or obj.fingerprint != fp:
+                if 'state' in ws:
+                    assert ws['state'] in [x[0] for x in Workspace.STATES]
+                obj._changed_fields = []
+                self._update_fields(obj, ws)
+                obj.fingerprint = fp
+                if not obj.id:
+                    logger.info('Creating new workspace: %s' % obj)
+                    obj.save()
+                else:
+                    obj.save(update_fields=obj._changed_fields + ['fingerprint'])
+            if ws_lists is not None:
+                self._update_workspace_lists(obj, ws_lists)
             syncher.mark(obj)
 
         syncher.finish()
 
-    def _update_tasks(self, workspace, task_or_tasks):
-        def close_task(task):
-            if task.state == 'closed':
-                return
-            logger.debug("Marking %s closed" % task)
-            task.set_state('closed')
+    def _update_tasks(self, workspace, task_or_tasks, skip_delete=False, context=None):
+        """
+        Synchronizes tasks of a workspace based on supplied data dicts
+
+        :param workspace: Workspace the tasks belong to
+        :param task_or_tasks: a single task dict or an iterable of them; tasks
+            are written in batches while the iterable is consumed. Only
+            origin_id is required for tasks that already exist. The iterable
+            may also contain Checkpoint markers.
+        :param skip_delete: if True, tasks missing from the list are not closed
+        :param context: TaskSyncContext to use instead of loading a new one
+        :returns: Counter of created, updated and closed tasks
+        """
+        stats = Counter()
+
+        def close_tasks(queryset):
+            count = queryset.exclude(state='closed').update(state='closed', fingerprint=None)
+            if count:
+                logger.debug("Marked %d tasks of %s closed" % (count, workspace))
+            stats['closed'] += count
 
-        skip_delete = False
+        queryset = workspace.tasks.all()
+        origin_ids = None
         if isinstance(task_or_tasks, dict):
             tasks = [task_or_tasks]
             skip_delete = True
+            # Load only the one task instead of the whole workspace
+            origin_ids = [task_or_tasks['origin_id']]
+            queryset = queryset.filter(origin_id__in=origin_ids)
         else:
             tasks = task_or_tasks
 
-        users = self.data_source.data_source_users.all().select_related('user')
-        users_by_id = {u.origin_id: u for u in users}
+        if context is None:
+            context = TaskSyncContext(workspace, self.user_cache, origin_ids)
+
+        syncher = CompactModelSyncher(queryset, 'origin_id', ('fingerprint',),
+                                      bulk_delete_func=close_tasks,
+                                      skip_delete=skip_delete,
+                                      delete_limit=None)
+
+        # Tasks that need to be updated, along with their primary keys
+        # and fingerprints
+        pending = []
+        # Checkpoints reached, but not yet covered by a written batch
+        checkpoints = []
+
+        def flush():
+            with self.metrics.phase('diff'):
+                changed = self._diff_tasks(workspace, syncher, pending, context)
+            with self.metrics.phase('write'):
+                stats.update(self._write_tasks(changed, context.assignments_by_task))
+            del pending[:]
+            for checkpoint in checkpoints:
+                checkpoint()
+            del checkpoints[:]
+            context.users_reloaded = False
+
+        # Write what was received before the source failed, so that a
+        # retry can continue from the last checkpoint.
+        for task in self._iter_tasks(tasks, on_error=flush):
+            if isinstance(task, Checkpoint):
+                checkpoints.append(task)
+                continue
+            self._queue_task(task, syncher, context, pending)
+            if len(pending) >= DEFAULT_BATCH_SIZE:
+                flush()
+
+        flush()
 
-        lists_by_id = {l.origin_id: l for l in workspace.lists.all()}
+        with self.metrics.phase('finish'):
+            syncher.finish()
+        return stats
+
+    @staticmethod
+    def _iter_tasks(tasks, on_error):
+        """
+        Yield the items of `tasks`, calling `on_error` before passing on an
+        exception raised by the iterable
+        """
+        tasks = iter(tasks)
+        while True:
+            try:
+                task = next(tasks)
+            except StopIteration:
+                return
+            except Exception:
+                on_error()
+                raise
+            yield task
 
+    def _queue_task(self, task, syncher, context, pending):
+        """
+        Append a task dict to `pending` along with the primary key and the
+        new fingerprint of the task, unless it has not changed since it was
+        last written
+        """
+        task = task.copy()
+        syncher.mark(task['origin_id'])
+        entry = syncher.get(task['origin_id'])
+        with self.metrics.phase('diff'):
+            fp = context.fingerprint(task)
+        if entry is not None and entry[1] == fp:
+            return
+        pending.append((entry[0] if entry else None, fp, task))
+
+    def _diff_tasks(self, workspace, syncher, pending, context):
+        """
+        Load the full objects of a batch of tasks and apply the changes
+
+        :param pending: list of (primary key or None, fingerprint, task dict) tuples
+        :returns: list of (task, set of assigned data source user ids) tuples
+            for the tasks that need to be written
+        """
         Task = workspace.tasks.model
-        syncher = ModelSyncher(workspace.tasks.all(),
-                               lambda task: task.origin_id,
-                               delete_func=close_task,
-                               skip_delete=skip_delete,
-                               delete_limit=None)
-        for task in tasks:
-            task = task.copy()
-            task_id = task.pop('origin_id')
-            obj = syncher.get(task_id)
+        objs = syncher.load([pk for pk, fp, task in pending if pk])
+
+        changed = []
+        for pk, fp, task in pending:
+            obj = objs.get(pk) if pk else None
             if not obj:
-                obj = Task(workspace=workspace, origin_id=task_id)
+                obj = Task(workspace=workspace, origin_id=task['origin_id'])
+            new_assignees, complete = self._apply_task(obj, task, context)
+            if not complete:
+                # Import the task again in the next sync, when the missing
+                # users may have been saved
+                fp = None
+
+            fp_changed = obj.fingerprint != fp
+            obj.fingerprint = fp
+            if obj._changed_fields or obj.id is None or fp_changed:
+                changed.append((obj, new_assignees))
+        return changed
+
+    def _apply_task(self, obj, task, context):
+        """
+        Apply a task dict to a task object, recording the changed fields
 
-            syncher.mark(obj)
-            task_state = task.pop('state', None)
+        :returns: tuple of the set of the data source user ids assigned to
+            the task, and whether all of the assigned users were found
+        """
+        task_id = task.pop('origin_id')
+
+        # Partial task dicts leave the missing state, list and
+        # assignments of existing tasks untouched.
+        task_state = task.pop('state', None) or obj.state or None
 
-            assigned_users = task.pop('assigned_users')
+        assigned_users = task.pop('assigned_users', None)
 
-            list_id = task.pop('list_origin_id', None)
-            obj.list = lists_by_id.get(list_id)
+        old_list_id = obj.list_id
+        if 'list_origin_id' in task:
+            obj.list = context.lists_by_id.get(task.pop('list_origin_id'))
 
-            # Inherit project setting from parent if not provided here
-            if 'project' not in task:
-                if workspace.projects.count() == 1:
-                    task['project'] = workspace.projects.first()
+        # Inherit project setting from parent if not provided here
+        if 'project' not in task and context.inherited_project:
+            task['project'] = context.inherited_project
 
-            self._update_fields(obj, task)
+        self._update_fields(obj, task)
 
-            if obj.list and obj.list.task_state:
-                task_state = obj.list.task_state
+        if obj.list_id != old_list_id:
+            obj._changed_fields.append('list')
 
-            if obj.state != task_state:
-                obj._changed_fields.append('state')
-            obj.set_state(task_state, save=False)
-            obj.save()
+        lst = context.lists_by_pk.get(obj.list_id)
+        if lst and lst.task_state:
+            task_state = lst.task_state
+
+        if obj.state != task_state:
+            obj._changed_fields.append('state')
+        obj.set_state(task_state, save=False)
+
+        old_assignees = context.assignments_by_task.get(obj.id, set())
+        if assigned_users is None:
+            return old_assignees, True
+        new_assignees = context.resolve_assignees(task_id, assigned_users)
+        if new_assignees != old_assignees:
+            obj._changed_fields.append('assignments')
+        return new_assignees, len(new_assignees) == len(set(assigned_users))
+
+    def _write_tasks(self, changed, assignments_by_task):
+        """
+        Write changed tasks and their assignments to the database in bulk
 
-            new_assignees = set()
-            for user_id in assigned_users:
-                user = users_by_id.get(user_id)
-                if not user:
-                    logger.error('Task %s: user with id %s not found' % (task_id, user_id))
-                    continue
-                new_assignees.add(user)
-            old_assignees = set([x.user for x in obj.assignments.all()])
+        :param changed: list of (task, set of assigned data source user ids) tuples
+        :param assignments_by_task: ids of the currently assigned users as
+            {task_id: set of user_ids}, updated to match the written tasks
+        :returns: Counter of created and updated tasks
+        """
+        stats = Counter()
+        if not changed:
+            return stats
 
-            added_assignees = new_assignees - old_assignees
-            for user in added_assignees:
-                obj.assignments.create(user=user)
-            removed_assignees = old_assignees - new_assignees
-            if removed_assignees:
-                obj.assignments.filter(user__in=removed_assignees).delete()
+        Task = changed[0][0]._meta.model
+        for obj, _ in changed:
+            stats['created' if obj.id is None else 'updated'] += 1
 
-            if added_assignees or removed_assignees:
-                obj._changed_fields.append('assignments')
+        with transaction.atomic():
+            bulk_upsert(Task, [obj for obj, _ in changed], ('workspace', 'origin_id'))
+            self._write_assignments(changed, assignments_by_task)
 
+        for obj, _ in changed:
             if obj._changed_fields:
                 logger.info('#{}: [{}] {} (changed: {})'.format(
-                    task_id, obj.state, obj.name, ', '.join(obj._changed_fields)
+                    obj.origin_id, obj.state, obj.name, ', '.join(obj._changed_fields)
                 ))
+        return stats
 
-        syncher.finish()
+    def _write_assignments(self, changed, assignments_by_task):
+        """
+        Add and remove the task assignments that differ from the current ones
+
+        Assignments are identified by their task and user, because the ids
+        of bulk created rows are not known on all database backends.
+        """
+        TaskAssignment = apps.get_model(app_label='workspaces', model_name='TaskAssignment')
+
+        added = []
+        removed = []
+        for obj, new_assignees in changed:
+            old_assignees = assignments_by_task.get(obj.id, set())
+            added += [TaskAssignment(task_id=obj.id, user_id=user_id) for user_id in new_assignees - old_assignees]
+            if old_assignees - new_assignees:
+                removed.append(Q(task_id=obj.id, user_id__in=old_assignees - new_assignees))
+            assignments_by_task[obj.id] = set(new_assignees)
+
+        for batch in chunked(removed, DEFAULT_BATCH_SIZE):
+            TaskAssignment.objects.filter(functools.reduce(operator.or_, batch)).delete()
+        if added:
+            TaskAssignment.objects.bulk_create(added, batch_size=DEFAULT_BATCH_SIZE)
+
+    def _get_sync_watermark(self, workspace, full=False):
+        """
+        Return the time from which changes should be fetched for an
+        incremental sync, or None if a full sync is needed.
+        """
+        if full or not workspace.tasks_synced_at:
+            return None
+        return workspace.tasks_synced_at - WATERMARK_OVERLAP
+
+    def _set_sync_watermark(self, workspace, started_at):
+        workspace.tasks_synced_at = started_at
+        workspace.sync_checkpoint = None
+        workspace.save(update_fields=['tasks_synced_at', 'sync_checkpoint'])
+
+    def _get_sync_checkpoint(self, workspace, key):
+        """
+        Return the checkpoint left by an interrupted fetch of the given
+        resource, or None if there is none
+        """
+        checkpoint = workspace.sync_checkpoint
+        if not checkpoint or checkpoint['key'] != key:
+            return None
+        return checkpoint
+
+    def _save_sync_checkpoint(self, workspace, key, next_url, started_at):
+        """
+        Remember the next page to fetch, so that an interrupted sync can be
+        continued from it
+        """
+        workspace.sync_checkpoint = dict(key=key, url=next_url, started_at=started_at.isoformat())
+        type(workspace).objects.filter(pk=workspace.pk).update(sync_checkpoint=workspace.sync_checkpoint)
 
     def sync_workspaces(self, origin_id=None):
         raise NotImplementedError()
 
-    def sync_tasks(self, workspace):
+    def sync_tasks(self, workspace, origin_id=None, full=False):
         """
         Read tasks for a given workspace.
+
+        Unless `full` is set, only tasks changed since the previous sync
+        are fetched. Only full syncs close tasks missing from the source.
+
+        :returns: Counter of created, updated and closed tasks
         """
         raise NotImplementedError()
 
+    def sync_all_tasks(self, full=False):
+        """
+        Read tasks for all sync-enabled workspaces of the data source.
+
+        :returns: Counter of created, updated and closed tasks
+        """
+        stats = Counter()
+        for workspace in self.data_source.workspaces.filter(sync=True):
+            stats.update(workspace.sync_tasks(full=full))
+        return stats
+
+    def sync_selected_tasks(self, workspace, origin_ids):
+        """
+        Read the given tasks of a workspace.
+
+        :returns: Counter of created, updated and closed tasks
+        """
+        stats = Counter()
+        for origin_id in origin_ids:
+            stats.update(self.sync_tasks(workspace, origin_id))
+        return stats
+
     def sync_single_task(self, workspace, task_origin_id):
         """
         Read a single task for a given workspace.
         """
         raise NotImplementedError()
 
-    def save_users(self, users):
-        def mark_inactive(dsu):
-            # Currently we don't mark DataSourceUsers inactive
-            return
+    def _import_pages(self, pages, get_users, import_user, import_task):
+        """
+        Convert pages of API objects to task dicts
+
+        The pages are gathered into batches of about DEFAULT_BATCH_SIZE
+        objects, and the users of each batch are saved at once before its
+        tasks are yielded. Checkpoint markers among the pages are yielded
+        after the tasks before them. If reading the pages fails, the tasks
+        read so far are yielded before the exception is raised, so that they
+        can be written up to the last checkpoint.
+
+        :param get_users: function returning the API user dicts of an object
+        :param import_user: function converting an API user dict
+        :param import_task: function converting an API object
+        """
+        batch = []
+        size = 0
+        pages = iter(pages)
+        while True:
+            try:
+                page = next(pages)
+            except StopIteration:
+                break
+            except Exception:
+                yield from self._import_batch(batch, get_users, import_user, import_task)
+                raise
+            batch.append(page)
+            if not isinstance(page, Checkpoint):
+                size += len(page)
+            if size >= DEFAULT_BATCH_SIZE:
+                yield from self._import_batch(batch, get_users, import_user, import_task)
+                batch = []
+                size = 0
+        yield from self._import_batch(batch, get_users, import_user, import_task)
+
+    def _import_batch(self, batch, get_users, import_user, import_task):
+        with self.metrics.phase('import'):
+            pages = [page for page in batch if not isinstance(page, Checkpoint)]
+            users = {}
+            for page in pages:
+                for obj in page:
+                    users.update((user['id'], user) for user in get_users(obj))
+            if users:
+                self.save_users([import_user(user) for user in users.values()])
+
+            items = []
+            for page in batch:
+                if isinstance(page, Checkpoint):
+                    items.append(page)
+                else:
+                    items += [import_task(obj) for obj in page]
+        return items
+
+    def _is_outdated(self, workspace, origin_id, updated_at):
+        """
+        Return True if the stored task has been updated after the given
+        time, e.g. when webhook deliveries arrive out of order
+        """
+        stored = workspace.tasks.filter(origin_id=origin_id).values_list('updated_at', flat=True).first()
+        return stored is not None and stored > parse_datetime(updated_at)
 
-        DataSourceUser = self.data_source.data_source_users.model
-        syncher = ModelSyncher(self.data_source.data_source_users.all(),
-                               lambda dsu: dsu.origin_id,
-                               delete_func=mark_inactive, delete_limit=None)
-        for user in users:
-            obj = syncher.get(user['origin_id'])
-            if not obj:
-                obj = DataSourceUser(data_source=self.data_source)
-            for attr_name, value in user.items():
-                setattr(obj, attr_name, value)
-            if not obj.id:
-                logger.debug('Creating new data source user: %s' % obj)
-            obj.save()
-            syncher.mark(obj)
+    def save_users(self, users):
+        """
+        Create or update the data source users in the given data dicts
 
-        syncher.finish()
+        Users that have not changed are not written. Users missing from
+        the list are left as they are.
+        """
+        self.user_cache.save(users)
 
     def save_webhook(self, webhook):
         self.data_source.webhooks.create(origin_id=webhook['origin_id'])
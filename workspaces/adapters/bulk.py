@@ -0,0 +1,106 @@
+from django.db import connections, router
+
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def chunked(items, size):
+    """
+    Split a list into lists of at most `size` items
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _pg_upsert(model, objs, conflict_fields, update_fields, connection):
+    meta = model._meta
+    qn = connection.ops.quote_name
+    fields = [f for f in meta.concrete_fields if not f.primary_key]
+    conflict_columns = [meta.get_field(name).column for name in conflict_fields]
+    conflict_attnames = [meta.get_field(name).attname for name in conflict_fields]
+
+    rows = []
+    params = []
+    for obj in objs:
+        add = obj.pk is None
+        values = [f.get_db_prep_save(f.pre_save(obj, add), connection=connection) for f in fields]
+        rows.append('(%s)' % ', '.join(['%s'] * len(values)))
+        params += values
+
+    if update_fields is None:
+        update_columns = [f.column for f in fields if f.column not in conflict_columns]
+    else:
+        update_columns = [meta.get_field(name).column for name in update_fields]
+    if not update_columns:
+        # Updating a conflict column to itself keeps RETURNING working
+        update_columns = conflict_columns[:1]
+    sql = 'INSERT INTO {table} ({columns}) VALUES {rows} ON CONFLICT ({conflict}) DO UPDATE SET {updates} ' \
+          'RETURNING {pk}, {conflict}'.format(
+              table=qn(meta.db_table),
+              columns=', '.join(qn(f.column) for f in fields),
+              rows=', '.join(rows),
+              conflict=', '.join(qn(c) for c in conflict_columns),
+              updates=', '.join('{0} = EXCLUDED.{0}'.format(qn(c)) for c in update_columns),
+              pk=qn(meta.pk.column))
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        pks = {tuple(row[1:]): row[0] for row in cursor.fetchall()}
+
+    for obj in objs:
+        obj.pk = pks[tuple(getattr(obj, name) for name in conflict_attnames)]
+        obj._state.adding = False
+        obj._state.db = connection.alias
+
+
+def _generic_upsert(model, objs, conflict_fields, update_fields, using):
+    conflict_attnames = [model._meta.get_field(name).attname for name in conflict_fields]
+
+    new_objs = []
+    for obj in objs:
+        if obj.pk is None:
+            new_objs.append(obj)
+        else:
+            obj.save(using=using, update_fields=update_fields)
+    if not new_objs:
+        return
+
+    model.objects.using(using).bulk_create(new_objs)
+    if new_objs[0].pk is not None:
+        return
+
+    # Not all backends return primary keys from bulk inserts, so we
+    # look them up using the unique fields.
+    filters = {}
+    for name in conflict_attnames:
+        filters[name + '__in'] = set(getattr(obj, name) for obj in new_objs)
+    qs = model.objects.using(using).filter(**filters).values_list('pk', *conflict_attnames)
+    pks = {tuple(row[1:]): row[0] for row in qs}
+    for obj in new_objs:
+        obj.pk = pks[tuple(getattr(obj, name) for name in conflict_attnames)]
+        obj._state.adding = False
+        obj._state.db = using
+
+
+def bulk_upsert(model, objs, conflict_fields, update_fields=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert new and update existing objects using as few queries as possible
+
+    On PostgreSQL this is done with INSERT ... ON CONFLICT DO UPDATE; on
+    other backends new objects are bulk inserted and existing ones saved
+    one by one. Primary keys of the inserted objects are set on them.
+
+    :param model: Django model class of the objects
+    :param objs: list of model instances to write
+    :param conflict_fields: names of the fields that uniquely identify a row
+    :param update_fields: names of the fields written to existing rows,
+        all of them by default
+    :param batch_size: maximum number of rows written per statement
+    """
+    using = router.db_for_write(model)
+    connection = connections[using]
+    for batch in chunked(objs, batch_size):
+        if connection.vendor == 'postgresql':
+            _pg_upsert(model, batch, conflict_fields, update_fields, connection)
+        else:
+            _generic_upsert(model, batch, conflict_fields, update_fields, using)
@@ -0,0 +1,504 @@
+"""
+Stand-in GitHub and Trello APIs for running syncs without network access
+
+The fakes are transport adapters for requests. They are mounted on the
+shared HTTP session of an API, so the real adapters can be run against
+them unchanged:
+
+    fake = FakeGitHub.generate('City-of-Helsinki', repos=2, issues=10000)
+    with fake.installed():
+        workspace.sync_tasks()
+
+The served data lives in `fake.state` and can be saved to and loaded from
+a JSON file, so recorded API responses can be replayed as well.
+"""
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from django.utils.dateparse import parse_datetime
+
+from .github import GitHubAdapter
+from .session import get_session
+from .trello import TrelloAdapter
+
+
+def format_time(dt):
+    return dt.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class FakeTransport(BaseAdapter):
+    """
+    Base class for fake APIs
+
+    Subclasses list their endpoints in `ROUTES` as (method, path regex,
+    handler method name) tuples. Handlers are called with the matched path
+    groups and the query parameters, and return a tuple of the status code,
+    JSON body and extra headers.
+
+    :param state: served data, see the subclasses for the format
+    :param latency: seconds to wait before each response
+    :param rate_limit: number of requests allowed per rate limit window;
+        further requests in the window are rejected
+    """
+    API_BASE = None
+    ROUTES = ()
+    RATE_LIMIT_WINDOW = 3600
+
+    def __init__(self, state=None, latency=0, rate_limit=5000):
+        super().__init__()
+        self.state = state if state is not None else self.empty_state()
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.requests = []
+        self.remaining = rate_limit
+        self.reset_at = time.time() + self.RATE_LIMIT_WINDOW
+        self.failures = []
+        self.routes = [(method, re.compile(pattern + '$'), getattr(self, name))
+                       for method, pattern, name in self.ROUTES]
+
+    @classmethod
+    def empty_state(cls):
+        return {}
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path, 'r') as f:
+            return cls(state=json.load(f), **kwargs)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.state, f)
+
+    @contextmanager
+    def installed(self):
+        """
+        Serve the requests to this API from the fake while the block runs
+        """
+        session = get_session(self.API_BASE)
+        old_adapter = session.get_adapter(self.API_BASE)
+        session.mount(self.API_BASE, self)
+        try:
+            yield self
+        finally:
+            session.mount(self.API_BASE, old_adapter)
+
+    def fail(self, url_part, count=1, status=502):
+        """
+        Make the next `count` requests to URLs containing `url_part` fail
+        with the given status
+        """
+        with self.lock:
+            self.failures.append([url_part, count, status])
+
+    def _pop_failure(self, url):
+        for failure in self.failures:
+            url_part, count, status = failure
+            if url_part in url and count > 0:
+                failure[1] -= 1
+                return status
+        return None
+
+    def rate_limit_headers(self):
+        return {}
+
+    def rate_limited_response(self):
+        return 429, dict(message='Rate limit exceeded'), {}
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+
+        parts = urlsplit(request.url)
+        path = parts.path[len(urlsplit(self.API_BASE).path):]
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        with self.lock:
+            self.requests.append((request.method, request.url))
+            if time.time() >= self.reset_at:
+                self.remaining = self.rate_limit
+                self.reset_at = time.time() + self.RATE_LIMIT_WINDOW
+            rate_limited = self.remaining == 0
+            self.remaining = max(self.remaining - 1, 0)
+            rate_headers = self.rate_limit_headers()
+            failure_status = self._pop_failure(request.url)
+
+        if rate_limited:
+            status, body, headers = self.rate_limited_response()
+        elif failure_status:
+            status, body, headers = failure_status, dict(message='Server Error'), {}
+        else:
+            status, body, headers = self.dispatch(request, path, query)
+
+        headers = dict(headers, **rate_headers)
+        content = json.dumps(body).encode('utf8')
+        if request.method == 'GET' and status == 200:
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()
+            headers['ETag'] = etag
+            if request.headers.get('If-None-Match') == etag:
+                status, content = 304, b''
+        return self.build_response(request, status, content, headers)
+
+    def dispatch(self, request, path, query, method=None):
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if route_method == (method or request.method) and match:
+                return handler(request, query, *match.groups())
+        return 404, dict(message='Not Found'), {}
+
+    def build_response(self, request, status, content, headers):
+        resp = Response()
+        resp.status_code = status
+        resp.reason = {200: 'OK', 201: 'Created', 304: 'Not Modified', 403: 'Forbidden', 404: 'Not Found',
+                       429: 'Too Many Requests', 500: 'Internal Server Error', 502: 'Bad Gateway',
+                       503: 'Service Unavailable', 504: 'Gateway Timeout'}.get(status, '')
+        resp.headers = CaseInsensitiveDict(headers)
+        resp.headers['Content-Type'] = 'application/json; charset=utf-8'
+        resp._content = content
+        resp.encoding = 'utf-8'
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        return resp
+
+    def paginate(self, request, query, items, page_size):
+        """
+        Return one page of `items` with GitHub-style Link headers
+        """
+        page = int(query.get('page', 1))
+        page_size = int(query.get('per_page', page_size))
+        last_page = max((len(items) + page_size - 1) // page_size, 1)
+
+        parts = urlsplit(request.url)
+
+        def link(page, rel):
+            url = urlunsplit(parts._replace(query=urlencode(dict(query, page=page))))
+            return '<{}>; rel="{}"'.format(url, rel)
+
+        links = []
+        if page < last_page:
+            links += [link(page + 1, 'next'), link(last_page, 'last')]
+        if page > 1:
+            links += [link(1, 'first'), link(page - 1, 'prev')]
+        headers = {'Link': ', '.join(links)} if links else {}
+        return items[(page - 1) * page_size:page * page_size], headers
+
+    def close(self):
+        pass
+
+
+class FakeGitHub(FakeTransport):
+    """
+    Fake GitHub API
+
+    The state is a dict with `repos` mapping organization names to lists of
+    repositories and `issues` mapping "org/repo" names to lists of issues.
+    """
+    API_BASE = GitHubAdapter.API_BASE
+    PAGE_SIZE = 30
+    ROUTES = (
+        ('GET', r'orgs/([^/]+)/repos', 'get_org_repos'),
+        ('GET', r'orgs/([^/]+)/issues', 'get_org_issues'),
+        ('GET', r'repos/([^/]+/[^/]+)', 'get_repo'),
+        ('GET', r'repos/([^/]+/[^/]+)/issues', 'get_issues'),
+        ('GET', r'repos/([^/]+/[^/]+)/issues/(\d+)', 'get_issue'),
+    )
+
+    @classmethod
+    def empty_state(cls):
+        return dict(repos={}, issues={})
+
+    @classmethod
+    def generate(cls, organization, repos=1, issues=100, users=20, closed=0.2, seed=0, **kwargs):
+        """
+        Create a fake with randomly generated repositories and issues
+
+        :param organization: name of the organization owning the repositories
+        :param repos: number of repositories
+        :param issues: number of issues per repository
+        :param users: number of possible assignees
+        :param closed: share of closed issues
+        """
+        rnd = random.Random(seed)
+        fake = cls(**kwargs)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        all_users = [dict(id=1000 + i, login='user%d' % i) for i in range(users)]
+        for i in range(repos):
+            repo = fake.add_repo(organization, dict(id=100 + i, name='repo%d' % i, description=None))
+            for number in range(1, issues + 1):
+                created_at = now - datetime.timedelta(minutes=rnd.randint(60, 60 * 24 * 365))
+                state = 'closed' if rnd.random() < closed else 'open'
+                fake.add_issue(repo, dict(
+                    number=number, title='Issue %d' % number, state=state,
+                    assignees=rnd.sample(all_users, rnd.randint(0, min(2, users))),
+                    created_at=format_time(created_at), updated_at=format_time(created_at),
+                    closed_at=format_time(created_at) if state == 'closed' else None,
+                ))
+        return fake
+
+    def add_repo(self, organization, repo):
+        self.state['repos'].setdefault(organization, []).append(repo)
+        full_name = '{}/{}'.format(organization, repo['name'])
+        self.state['issues'].setdefault(full_name, [])
+        return full_name
+
+    def add_issue(self, full_name, issue):
+        self.state['issues'][full_name].append(issue)
+
+    def update_issue(self, full_name, number, **changes):
+        """
+        Change an issue, bumping its modification time
+        """
+        issue = next(i for i in self.state['issues'][full_name] if i['number'] == number)
+        issue.update(changes)
+        issue['updated_at'] = format_time(datetime.datetime.now(datetime.timezone.utc))
+        return issue
+
+    def rate_limit_headers(self):
+        return {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(int(self.reset_at)),
+        }
+
+    def rate_limited_response(self):
+        return 403, dict(message='API rate limit exceeded'), {}
+
+    def get_org_repos(self, request, query, organization):
+        repos = self.state['repos'].get(organization)
+        if repos is None:
+            return 404, dict(message='Not Found'), {}
+        page, headers = self.paginate(request, query, repos, self.PAGE_SIZE)
+        return 200, page, headers
+
+    def get_repo(self, request, query, full_name):
+        organization, name = full_name.split('/')
+        for repo in self.state['repos'].get(organization, []):
+            if repo['name'] == name:
+                return 200, repo, {}
+        return 404, dict(message='Not Found'), {}
+
+    def get_org_issues(self, request, query, organization):
+        repos = self.state['repos'].get(organization)
+        if repos is None:
+            return 404, dict(message='Not Found'), {}
+        issues = []
+        for repo in repos:
+            repository = dict(id=repo['id'], name=repo['name'])
+            full_name = '{}/{}'.format(organization, repo['name'])
+            issues += [dict(issue, repository=repository) for issue in self.state['issues'][full_name]]
+        return self.list_issues(request, query, issues)
+
+    def get_issues(self, request, query, full_name):
+        issues = self.state['issues'].get(full_name)
+        if issues is None:
+            return 404, dict(message='Not Found'), {}
+        return self.list_issues(request, query, issues)
+
+    def list_issues(self, request, query, issues):
+        state = query.get('state', 'open')
+        if state != 'all':
+            issues = [i for i in issues if i['state'] == state]
+        if 'since' in query:
+            # Both are formatted the same way, so they compare as strings
+            issues = [i for i in issues if i['updated_at'] >= query['since']]
+        page, headers = self.paginate(request, query, issues, self.PAGE_SIZE)
+        return 200, page, headers
+
+    def get_issue(self, request, query, full_name, number):
+        for issue in self.state['issues'].get(full_name, []):
+            if issue['number'] == int(number):
+                return 200, issue, {}
+        return 404, dict(message='Not Found'), {}
+
+
+class FakeTrello(FakeTransport):
+    """
+    Fake Trello API
+
+    The state is a dict with `boards` mapping board ids to boards, each of
+    which has `lists`, `cards`, `members`, `former_members` and `actions`,
+    and `organizations` mapping organization names to lists of board ids.
+    """
+    API_BASE = TrelloAdapter.API_BASE
+    RATE_LIMIT_WINDOW = 10
+    ROUTES = (
+        ('GET', r'organizations/([^/]+)/boards', 'get_org_boards'),
+        ('GET', r'boards/([^/]+)', 'get_board'),
+        ('GET', r'boards/([^/]+)/cards', 'get_board_cards'),
+        ('GET', r'boards/([^/]+)/actions', 'get_board_actions'),
+        ('GET', r'cards/([^/]+)', 'get_card'),
+        ('GET', r'members/([^/]+)', 'get_member'),
+        ('GET', r'batch', 'get_batch'),
+    )
+
+    def __init__(self, state=None, latency=0, rate_limit=100):
+        super().__init__(state, latency, rate_limit)
+
+    @classmethod
+    def empty_state(cls):
+        return dict(organizations={}, boards={})
+
+    @classmethod
+    def generate(cls, organization, boards=1, lists=5, cards=100, members=20, closed=0.1, seed=0, **kwargs):
+        """
+        Create a fake with randomly generated boards and cards
+
+        :param organization: name of the organization owning the boards
+        :param boards: number of boards
+        :param lists: number of lists per board
+        :param cards: number of cards per board
+        :param members: number of members per board
+        :param closed: share of archived cards
+        """
+        rnd = random.Random(seed)
+        fake = cls(**kwargs)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for i in range(boards):
+            board_id = 'board%d' % i
+            fake.add_board(organization, dict(
+                id=board_id, name='Board %d' % i,
+                lists=[dict(id='%s-list%d' % (board_id, j), name='List %d' % j, pos=j * 1024.0, closed=False)
+                       for j in range(lists)],
+                members=[dict(id='member%d' % j, username='member%d' % j, fullName='Member %d' % j)
+                         for j in range(members)],
+            ))
+            board = fake.state['boards'][board_id]
+            for j in range(cards):
+                changed_at = now - datetime.timedelta(minutes=rnd.randint(60, 60 * 24 * 365))
+                board['cards'].append(dict(
+                    id='%s-card%d' % (board_id, j), name='Card %d' % j, pos=j * 1024.0,
+                    closed=rnd.random() < closed, idList=rnd.choice(board['lists'])['id'],
+                    idMembers=[m['id'] for m in rnd.sample(board['members'], rnd.randint(0, min(2, members)))],
+                    dateLastActivity=format_time(changed_at),
+                ))
+        return fake
+
+    def add_board(self, organization, board):
+        for key in ('lists', 'cards', 'members', 'former_members', 'actions'):
+            board.setdefault(key, [])
+        self.state['boards'][board['id']] = board
+        self.state['organizations'].setdefault(organization, []).append(board['id'])
+
+    def remove_member(self, board_id, member_id):
+        """
+        Remove a member from a board, leaving the cards assigned to them as
+        they are
+        """
+        board = self.state['boards'][board_id]
+        member = next(m for m in board['members'] if m['id'] == member_id)
+        board['members'].remove(member)
+        board['former_members'].append(member)
+        return member
+
+    def update_card(self, board_id, card_id, **changes):
+        """
+        Change a card, recording an updateCard action for it
+        """
+        board = self.state['boards'][board_id]
+        card = next(c for c in board['cards'] if c['id'] == card_id)
+        card.update(changes)
+        now = format_time(datetime.datetime.now(datetime.timezone.utc))
+        card['dateLastActivity'] = now
+        board['actions'].insert(0, dict(
+            id='action%d' % len(board['actions']), type='updateCard', date=now,
+            data=dict(card=dict(changes, id=card_id)),
+        ))
+        return card
+
+    def rate_limit_headers(self):
+        return {
+            'x-rate-limit-api-token-interval-ms': str(self.RATE_LIMIT_WINDOW * 1000),
+            'x-rate-limit-api-token-max': str(self.rate_limit),
+            'x-rate-limit-api-token-remaining': str(self.remaining),
+        }
+
+    def rate_limited_response(self):
+        return 429, 'API_TOKEN_LIMIT_EXCEEDED', {}
+
+    def card_with_members(self, board, card, query):
+        if query.get('members') != 'true':
+            return card
+        members = {m['id']: m for m in board['members'] + board['former_members']}
+        return dict(card, members=[members[member_id] for member_id in card['idMembers']])
+
+    def nested_board(self, board, query):
+        """
+        Return a board with the lists, cards and members asked for in the query
+        """
+        ret = dict(id=board['id'], name=board['name'])
+        for key in ('lists', 'cards'):
+            value = query.get(key, 'none')
+            if value == 'open':
+                ret[key] = [obj for obj in board[key] if not obj['closed']]
+            elif value == 'all':
+                ret[key] = board[key]
+        if query.get('members', 'none') != 'none':
+            ret['members'] = board['members']
+        return ret
+
+    def get_org_boards(self, request, query, organization):
+        board_ids = self.state['organizations'].get(organization)
+        if board_ids is None:
+            return 404, 'model not found', {}
+        return 200, [self.nested_board(self.state['boards'][i], query) for i in board_ids], {}
+
+    def get_board(self, request, query, board_id):
+        board = self.state['boards'].get(board_id)
+        if board is None:
+            return 404, 'model not found', {}
+        return 200, self.nested_board(board, query), {}
+
+    def get_board_cards(self, request, query, board_id):
+        board = self.state['boards'].get(board_id)
+        if board is None:
+            return 404, 'model not found', {}
+        cards = board['cards']
+        if query.get('filter', 'open') == 'open':
+            cards = [c for c in cards if not c['closed']]
+        return 200, [self.card_with_members(board, c, query) for c in cards], {}
+
+    def get_board_actions(self, request, query, board_id):
+        board = self.state['boards'].get(board_id)
+        if board is None:
+            return 404, 'model not found', {}
+        actions = board['actions']
+        if 'since' in query:
+            since = format_time(parse_datetime(query['since']))
+            actions = [a for a in actions if a['date'] >= since]
+        if 'filter' in query:
+            types = query['filter'].split(',')
+            actions = [a for a in actions if a['type'] in types]
+        return 200, actions[:int(query.get('limit', 50))], {}
+
+    def get_batch(self, request, query):
+        results = []
+        for route in query['urls'].split(','):
+            parts = urlsplit(route)
+            route_query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+            status, body, headers = self.dispatch(request, parts.path.lstrip('/'), route_query, method='GET')
+            results.append({str(status): body})
+        return 200, results, {}
+
+    def get_member(self, request, query, member_id):
+        for board in self.state['boards'].values():
+            for member in board['members'] + board['former_members']:
+                if member['id'] == member_id:
+                    return 200, member, {}
+        return 404, 'The requested resource was not found.', {}
+
+    def get_card(self, request, query, card_id):
+        for board in self.state['boards'].values():
+            for card in board['cards']:
+                if card['id'] == card_id:
+                    return 200, self.card_with_members(board, card, query), {}
+        return 404, 'The requested resource was not found.', {}
@@ -1,6 +1,9 @@
-import requests
+import datetime
 import logging
 import json
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 
 from django.db import transaction
 from django.apps import apps
@@ -8,8 +11,12 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.conf.urls import url
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from .base import Adapter
+from .base import Adapter, Checkpoint, TaskSyncContext
+from .bulk import DEFAULT_BATCH_SIZE
+from .metrics import SyncMetrics
 
 
 logger = logging.getLogger(__name__)
@@ -18,27 +25,144 @@ logger = logging.getLogger(__name__)
 class GitHubAdapter(Adapter):
     API_BASE = 'https://api.github.com/'
 
-    def api_get(self, path, **kwargs):
+    def get_rate_limit(self):
+        if self.data_source.token:
+            return (self.data_source.token, 5000, 3600)
+        # Unauthenticated requests are limited per IP address
+        return ('anonymous', 60, 3600)
+
+    def is_rate_limited(self, resp, state):
+        # Both the primary and the secondary rate limits are reported
+        # with 403 Forbidden
+        if resp.status_code == 403:
+            return state['remaining'] == 0 or state['retry_after'] is not None
+        return super().is_rate_limited(resp, state)
+
+    def _start_page(self, executor, url, headers, params):
+        """
+        Start fetching a single page in the background, sending the
+        validators of an earlier response so that an unchanged page is
+        served from the cache.
+
+        :returns: function returning a tuple of the parsed body and the
+            Link header values
+        """
+        HTTPCacheEntry = apps.get_model(app_label='workspaces', model_name='HTTPCacheEntry')
+        key = HTTPCacheEntry.make_key(url, params)
+        entry = None
+        if key:
+            # The body is only needed when the page has not changed
+            entries = self.data_source.http_cache_entries.only('etag', 'last_modified', 'updated_at')
+            entry = entries.filter(key=key).first()
+
+        headers = dict(headers or {})
+        if entry:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        get_response = self.start_request(executor, 'get', url, headers=headers, params=params)
+
+        def read_page():
+            resp = get_response()
+            if resp.status_code == 304 and entry:
+                logger.debug('%s not modified, using cached response' % url)
+                entry.touch()
+                body, links = HTTPCacheEntry.objects.values_list('body', 'links').get(pk=entry.pk)
+                return body, links or {}
+            assert resp.status_code == 200, "GitHub API error: %s" % resp.json()['message']
+            data = resp.json()
+
+            etag = resp.headers.get('ETag')
+            last_modified = resp.headers.get('Last-Modified')
+            if key and (etag or last_modified):
+                HTTPCacheEntry.objects.update_or_create(
+                    data_source=self.data_source, key=key,
+                    defaults=dict(url=url, etag=etag, last_modified=last_modified, links=resp.links, body=data)
+                )
+            return data, resp.links
+        return read_page
+
+    def _iter_parallel_pages(self, executor, next_url, last_url, headers):
+        """
+        Fetch the pages from `next_url` to `last_url` concurrently, yielding
+        them in page order along with the URL of the page after each.
+        """
+        next_parts = urlsplit(next_url)
+        query = parse_qs(next_parts.query)
+        first_page = int(query['page'][0])
+        last_page = int(parse_qs(urlsplit(last_url).query)['page'][0])
+
+        def url_of_page(page):
+            query['page'] = [str(page)]
+            return urlunsplit(next_parts._replace(query=urlencode(query, doseq=True)))
+
+        workers = self.data_source.fetch_workers
+        page_urls = [url_of_page(page) for page in range(first_page, last_page + 1)]
+        next_urls = page_urls[1:] + [None]
+        # Keep a limited number of pages in flight so that results don't
+        # pile up when the consumer is slower than the fetchers.
+        pending = deque()
+        for page_url, following_url in zip(page_urls, next_urls):
+            pending.append((self._start_page(executor, page_url, headers, None), following_url))
+            if len(pending) >= workers * 2:
+                read_page, url_after = pending.popleft()
+                yield read_page()[0], url_after
+        while pending:
+            read_page, url_after = pending.popleft()
+            yield read_page()[0], url_after
+
+    def _iter_pages(self, path, start_url=None, **kwargs):
+        """
+        Fetch a paginated resource, yielding each page along with the URL of
+        the next page, or None for the last one
+
+        The next page is fetched in the background while the caller handles
+        the current one. If the first page tells how many pages there are,
+        the rest of them are fetched in parallel.
+
+        :param start_url: URL of the page to start from, as yielded earlier
+        """
         # GitHub does not always require authorization
         if self.data_source.token:
             headers = {'Authorization': 'token {}'.format(self.data_source.token)}
         else:
             headers = None
-        url = self.API_BASE + path
+        if start_url:
+            # The links already include the query parameters
+            url = start_url
+            params = None
+        else:
+            url = self.API_BASE + path
+            params = kwargs
+        workers = self.data_source.fetch_workers
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            read_page = self._start_page(executor, url, headers, params)
+            while read_page:
+                data, links = read_page()
+                next_url = links['next']['url'] if 'next' in links else None
+                if not isinstance(data, list):
+                    assert not next_url
+                if next_url and 'last' in links and workers > 1:
+                    yield data, next_url
+                    yield from self._iter_parallel_pages(executor, next_url, links['last']['url'], headers)
+                    return
+                read_page = self._start_page(executor, next_url, headers, None) if next_url else None
+                yield data, next_url
+
+    def api_get_pages(self, path, **kwargs):
+        """
+        Fetch a paginated resource, yielding each page as it arrives
+        """
+        for data, next_url in self._iter_pages(path, **kwargs):
+            yield data
+
+    def api_get(self, path, **kwargs):
         objs = []
-        while True:
-            resp = requests.get(url, headers=headers, params=kwargs)
-            assert resp.status_code == 200, "GitHub API error: %s" % resp.json()['message']
-            data = resp.json()
-            next_link = resp.links.get('next')
-            if isinstance(data, list):
-                objs += data
-            else:
-                assert not next_link
+        for data in self.api_get_pages(path, **kwargs):
+            if not isinstance(data, list):
                 return data
-            if not next_link:
-                break
-            url = next_link['url']
+            objs += data
 
         return objs
 
@@ -48,7 +172,7 @@ class GitHubAdapter(Adapter):
         else:
             headers = None
         url = self.API_BASE + path
-        resp = requests.post(url, headers=headers, **kwargs)
+        resp = self.http_request('post', url, headers=headers, **kwargs)
         data = resp.json()
         assert resp.status_code == 201, "GitHub API error: %s" % data['message']
         return data
@@ -59,12 +183,13 @@ class GitHubAdapter(Adapter):
         else:
             headers = None
         url = self.API_BASE + path
-        resp = requests.delete(url, headers=headers, **kwargs)
+        resp = self.http_request('delete', url, headers=headers, **kwargs)
         assert resp.status_code in (200, 204), "GitHub API error: %s" % resp.json()['message']
 
     def _import_repo(self, data):
+        # Archived repositories are still listed, but they are read-only
         ret = dict(name=data['name'], description=data['description'], origin_id=str(data['id']),
-                   state='open')
+                   state='closed' if data.get('archived') else 'open')
         return ret
 
     def _import_issue(self, data):
@@ -92,35 +217,195 @@ class GitHubAdapter(Adapter):
             data = self.api_get('repos/%s' % origin_id)
             self._update_workspaces(self._import_repo(data))
 
-    def sync_tasks(self, workspace, origin_id=None):
+    def _import_issue_pages(self, pages, import_issue=None):
         """
-        Synchronize tasks between given workspace and its Trello source
+        Convert pages of issues to task dicts, saving their assignees
+        before the tasks are yielded.
+        """
+        return self._import_pages(pages, lambda issue: issue['assignees'], self._import_user,
+                                  import_issue or self._import_issue)
+
+    def sync_tasks(self, workspace, origin_id=None, full=False):
+        """
+        Synchronize tasks between given workspace and its GitHub source
         :param workspace: Workspace to be synced
         :param origin_id: Task id if only one task is to be synced
+        :param full: Fetch all issues instead of the ones changed since last sync
         """
 
         repo_part = '{}/{}'.format(self.data_source.organization, workspace.name)
-        if not origin_id:
-            data = self.api_get('repos/{}/issues'.format(repo_part), state='all')
-        else:
+        started_at = timezone.now()
+        if origin_id:
             card = self.api_get('repos/{}/issues/{}'.format(repo_part, origin_id))
-            data = [card]
+            tasks = list(self._import_issue_pages([[card]]))
+            return self._update_tasks(workspace, tasks[0])
+
+        path = 'repos/{}/issues'.format(repo_part)
+        params = dict(state='all')
+        since = self._get_sync_watermark(workspace, full)
+        if since:
+            params['since'] = since.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        skip_delete = since is not None
+
+        # An interrupted fetch of the same issues continues from the page
+        # after the last one whose tasks were written. Full syncs start
+        # over, as they need to see all the tasks to close missing ones.
+        key = '{}?{}'.format(path, urlencode(sorted(params.items())))
+        checkpoint = None if full else self._get_sync_checkpoint(workspace, key)
+        start_url = None
+        if checkpoint:
+            logger.info('Continuing interrupted sync of %s from %s' % (workspace, checkpoint['url']))
+            start_url = checkpoint['url']
+            started_at = parse_datetime(checkpoint['started_at'])
+            # The tasks on the earlier pages are not seen by this run
+            skip_delete = True
+
+        def add_checkpoints(pages):
+            for data, next_url in pages:
+                yield data
+                if next_url:
+                    yield Checkpoint(lambda url=next_url: self._save_sync_checkpoint(workspace, key, url, started_at))
+
+        pages = add_checkpoints(self._iter_pages(path, start_url=start_url, **params))
+        stats = self._update_tasks(workspace, self._import_issue_pages(pages), skip_delete=skip_delete)
+        self._set_sync_watermark(workspace, started_at)
+        return stats
+
+    def sync_all_tasks(self, full=False):
+        """
+        Synchronize the tasks of all sync-enabled repositories of the
+        organization
+
+        Issues changed since the previous sync are read from one listing of
+        the whole organization and routed to their workspaces by repository.
+        Repositories that have not been synced before, and all of them if
+        `full` is set, are synced one by one, which also closes tasks that
+        are missing from GitHub. GitHub lists the issues of an organization
+        only to authenticated users, so without a token all repositories are
+        synced one by one.
+
+        :returns: Counter of created, updated and closed tasks
+        """
+        stats = Counter()
+        streamed = []
+        for workspace in self.data_source.workspaces.filter(sync=True):
+            if full or not workspace.tasks_synced_at or not self.data_source.token:
+                stats.update(workspace.sync_tasks(full=full))
+            else:
+                streamed.append(workspace)
+        if streamed:
+            stats.update(self._sync_organization_issues(streamed))
+        return stats
 
-        tasks = [self._import_issue(card) for card in data]
-        all_users = {}
-        for issue in data:
-            for user in issue['assignees']:
-                if user['id'] in all_users:
-                    continue
-                all_users[user['id']] = user
+    def _sync_organization_issues(self, workspaces):
+        """
+        Update the tasks of the given workspaces from the issues of the
+        organization changed since the earliest of their previous syncs
+
+        A sync run is recorded for each of the workspaces. The requests made
+        for the shared listing, and the time spent fetching and importing
+        it, are divided evenly between them.
+        """
+        SyncRun = apps.get_model(app_label='workspaces', model_name='SyncRun')
+        started_at = timezone.now()
+        since = min(self._get_sync_watermark(workspace) for workspace in workspaces)
+        workspaces_by_repo = {workspace.origin_id: workspace for workspace in workspaces}
+        runs = {workspace.origin_id: SyncRun(data_source_id=self.data_source.pk, workspace=workspace,
+                                             started_at=started_at)
+                for workspace in workspaces}
+        metrics_by_repo = {repo_id: SyncMetrics() for repo_id in workspaces_by_repo}
+        stats_by_repo = defaultdict(Counter)
+        self.metrics = stream_metrics = SyncMetrics()
+        pending = defaultdict(list)
+        # Sync data of each workspace, loaded when its first batch is written
+        contexts = {}
+
+        def flush(repo_id):
+            workspace = workspaces_by_repo[repo_id]
+            self.metrics = metrics = metrics_by_repo[repo_id]
+            try:
+                with metrics.count_queries():
+                    if repo_id not in contexts:
+                        contexts[repo_id] = TaskSyncContext(workspace, self.user_cache)
+                    tasks = pending.pop(repo_id)
+                    stats_by_repo[repo_id].update(
+                        self._update_tasks(workspace, tasks, skip_delete=True, context=contexts[repo_id])
+                    )
+            finally:
+                self.metrics = stream_metrics
+
+        error = None
+        try:
+            with stream_metrics.count_queries():
+                for repo_id, task in self._iter_organization_issues(since, workspaces_by_repo):
+                    pending[repo_id].append(task)
+                    if len(pending[repo_id]) >= DEFAULT_BATCH_SIZE:
+                        flush(repo_id)
+            for repo_id in list(pending):
+                flush(repo_id)
+            for workspace in workspaces:
+                self._set_sync_watermark(workspace, started_at)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._save_stream_runs(runs, metrics_by_repo, stats_by_repo, stream_metrics, error)
+        return sum(stats_by_repo.values(), Counter())
+
+    def _iter_organization_issues(self, since, repo_ids):
+        """
+        Fetch the issues of the organization changed since the given time,
+        yielding (repository id, task dict) tuples for the given repositories
+        """
+        params = dict(filter='all', state='all',
+                      since=since.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        pages = self.api_get_pages('orgs/{}/issues'.format(self.data_source.organization), **params)
+        tasks = self._import_issue_pages(
+            pages, lambda issue: (str(issue['repository']['id']), self._import_issue(issue))
+        )
+        return ((repo_id, task) for repo_id, task in tasks if repo_id in repo_ids)
 
-        users = [self._import_user(user) for user in all_users.values()]
-        self.save_users(users)
+    def _save_stream_runs(self, runs, metrics_by_repo, stats_by_repo, stream_metrics, error=None):
+        """
+        Save the sync runs of the workspaces updated from an organization
+        issue listing, with an even share of the listing's metrics each
+        """
+        SyncRun = apps.get_model(app_label='workspaces', model_name='SyncRun')
+        finished_at = timezone.now()
+        for repo_id, run in runs.items():
+            if error is not None:
+                run.set_error(error)
+            metrics = metrics_by_repo[repo_id]
+            metrics.add_share(stream_metrics, 1 / len(runs))
+            run.finished_at = finished_at
+            run.set_metrics(metrics, stats_by_repo[repo_id])
+        SyncRun.objects.bulk_create(runs.values())
+
+    def apply_issue_event(self, workspace, action, issue):
+        """
+        Update a task from the issue included in an issues webhook event
 
-        if not origin_id:
-            self._update_tasks(workspace, tasks)
-        else:
-            self._update_tasks(workspace, tasks[0])
+        Events older than the stored issue are ignored.
+        """
+        if self._is_outdated(workspace, str(issue['number']), issue['updated_at']):
+            logger.debug('Ignoring outdated %s event of issue %s' % (action, issue['number']))
+            return Counter()
+        task = self._import_issue(issue)
+        if action in ('deleted', 'transferred'):
+            task['state'] = 'closed'
+        if issue['assignees']:
+            self.save_users([self._import_user(user) for user in issue['assignees']])
+        return self._update_tasks(workspace, task)
+
+    def apply_repository_event(self, action, repo):
+        """
+        Update a workspace from the repository included in a repository
+        webhook event
+        """
+        ws = self._import_repo(repo)
+        if action in ('deleted', 'archived', 'transferred'):
+            ws['state'] = 'closed'
+        self._update_workspaces(ws)
 
     def register_webhook(self, callback_url):
         config = dict(url=callback_url, content_type='json')
@@ -143,10 +428,9 @@ def handle_github_event(event_type, event):
 
     if event_type == 'issues':
         ws = ds.workspaces.get(origin_id=event['repository']['id'])
-        issue_id = str(event['issue']['number'])
-        ws.schedule_task_sync(issue_id)
+        ds.adapter.apply_issue_event(ws, event['action'], event['issue'])
     elif event_type == 'repository':
-        ds.schedule_workspace_sync()
+        ds.adapter.apply_repository_event(event['action'], event['repository'])
 
     return HttpResponse('OK')
 
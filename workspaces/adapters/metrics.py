@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.utils import CursorDebugWrapper
+
+
+class QueryCountingCursorWrapper(CursorDebugWrapper):
+    def __init__(self, cursor, db, metrics):
+        super().__init__(cursor, db)
+        self.metrics = metrics
+
+    def execute(self, sql, params=None):
+        self.metrics.add_queries(1)
+        return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.metrics.add_queries(1)
+        return super().executemany(sql, param_list)
+
+
+class SyncMetrics(object):
+    """
+    Timings and counters collected during one sync run
+
+    The counters may be updated from several threads, e.g. when pages
+    are fetched in parallel.
+    """
+    PHASES = ('fetch', 'import', 'diff', 'write', 'finish')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = Counter()
+        self.http_requests = 0
+        self.http_bytes = 0
+        self.sql_queries = 0
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.timings[phase] += seconds
+
+    def add_request(self, seconds, size):
+        with self.lock:
+            self.timings['fetch'] += seconds
+            self.http_requests += 1
+            self.http_bytes += size
+
+    def add_queries(self, count):
+        with self.lock:
+            self.sql_queries += count
+
+    def add_share(self, other, share):
+        """
+        Add a share of the timings and counters of another SyncMetrics, e.g.
+        of requests made for several workspaces at once
+
+        :param share: fraction of the other metrics to add
+        """
+        with self.lock:
+            for phase, seconds in other.timings.items():
+                self.timings[phase] += seconds * share
+            self.http_requests += round(other.http_requests * share)
+            self.http_bytes += round(other.http_bytes * share)
+            self.sql_queries += round(other.sql_queries * share)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Add the time spent in the block to the given phase
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - start)
+
+    @contextmanager
+    def count_queries(self, using=DEFAULT_DB_ALIAS):
+        """
+        Count the SQL queries made in this thread while the block runs
+
+        The blocks may be nested, in which case the queries are only counted
+        by the innermost one.
+        """
+        connection = connections[using]
+        old_force_debug_cursor = connection.force_debug_cursor
+        old_make_debug_cursor = connection.__dict__.get('make_debug_cursor')
+        connection.force_debug_cursor = True
+        connection.make_debug_cursor = lambda cursor: QueryCountingCursorWrapper(cursor, connection, self)
+        try:
+            yield
+        finally:
+            if old_make_debug_cursor is None:
+                del connection.make_debug_cursor
+            else:
+                connection.make_debug_cursor = old_make_debug_cursor
+            connection.force_debug_cursor = old_force_debug_cursor
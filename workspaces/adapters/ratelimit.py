@@ -0,0 +1,124 @@
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the requests made with one API credential
+
+    The bucket is stored in the database and locked while tokens are taken
+    from it, so all threads and processes using the same credential share
+    it. To keep the workers from queuing up on the lock, tokens are taken
+    in batches of up to SYNC_RATE_LIMIT_BATCH_SIZE and handed out from
+    memory. The bucket is also emptied according to the rate limit headers
+    of the API responses, in case someone else is using the credential.
+
+    :param credential: string identifying the API and the credential
+    :param capacity: maximum number of requests made in a burst
+    :param period: seconds it takes to refill an empty bucket
+    """
+
+    def __init__(self, credential, capacity, period):
+        self.key = hashlib.sha1(credential.encode('utf8')).hexdigest()
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = None
+        # A batch never takes more than a tenth of the bucket, so that other
+        # workers are not starved
+        self.batch_size = max(1, min(settings.SYNC_RATE_LIMIT_BATCH_SIZE, capacity // 10))
+        # Tokens taken from the bucket but not used yet
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    def _get_bucket(self):
+        RateLimitBucket = apps.get_model(app_label='workspaces', model_name='RateLimitBucket')
+        bucket, created = RateLimitBucket.objects.select_for_update().get_or_create(
+            key=self.key, defaults=dict(tokens=self.capacity, updated_at=timezone.now())
+        )
+        now = timezone.now()
+        elapsed = (now - bucket.updated_at).total_seconds()
+        bucket.tokens = min(self.capacity, bucket.tokens + max(elapsed, 0) * self.rate)
+        bucket.updated_at = now
+        return bucket
+
+    def acquire(self):
+        """
+        Take one token from the bucket, waiting until one is available
+
+        :raises RateLimitExceeded: if the wait would be longer than
+            SYNC_RATE_LIMIT_MAX_WAIT seconds
+        """
+        with self.lock:
+            if self.reserved >= 1:
+                self.reserved -= 1
+                return
+
+        while True:
+            with transaction.atomic():
+                bucket = self._get_bucket()
+                if bucket.blocked_until and bucket.blocked_until > bucket.updated_at:
+                    wait = (bucket.blocked_until - bucket.updated_at).total_seconds()
+                elif bucket.tokens >= 1:
+                    taken = min(self.batch_size, int(bucket.tokens))
+                    bucket.tokens -= taken
+                    wait = 0
+                else:
+                    wait = (1 - bucket.tokens) / self.rate
+                bucket.save()
+            self.tokens = bucket.tokens
+            if not wait:
+                with self.lock:
+                    self.reserved += taken - 1
+                return
+            if wait > settings.SYNC_RATE_LIMIT_MAX_WAIT:
+                raise RateLimitExceeded("Rate limit reached, next request allowed in %d s" % wait)
+            logger.debug("Rate limit reached, waiting %.1f s" % wait)
+            time.sleep(wait)
+
+    def update(self, remaining=None, reset_at=None, retry_after=None):
+        """
+        Adjust the bucket to the rate limit state reported by the API
+
+        :param remaining: number of requests the API still allows
+        :param reset_at: time when the API limit is reset
+        :param retry_after: seconds the API asked us to wait
+        """
+        blocked_until = None
+        if retry_after is not None:
+            blocked_until = timezone.now() + datetime.timedelta(seconds=retry_after)
+        elif remaining is not None and remaining < 1 and reset_at is not None:
+            blocked_until = reset_at
+        if blocked_until is None and (remaining is None or self.tokens is None or
+                                      remaining >= min(self.tokens, self.capacity * 0.1)):
+            # Until the API limit is nearly used up, the bucket is trusted
+            # to keep the pace, saving a database update per request.
+            return
+
+        if blocked_until is not None:
+            with self.lock:
+                self.reserved = 0
+
+        with transaction.atomic():
+            bucket = self._get_bucket()
+            if remaining is not None:
+                bucket.tokens = min(bucket.tokens, remaining)
+            if blocked_until is not None:
+                bucket.tokens = 0
+                if not bucket.blocked_until or bucket.blocked_until < blocked_until:
+                    bucket.blocked_until = blocked_until
+            bucket.save()
+        self.tokens = bucket.tokens
@@ -0,0 +1,40 @@
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(base_url):
+    """
+    Return the process-wide HTTP session for the given API base URL
+
+    The session keeps connections to the API host alive between requests
+    and adapter instances. Authentication is not stored in the session,
+    but is passed with each request by the adapters.
+    """
+    with _sessions_lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            # Cookies must not leak between data sources using the same session
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            pool_size = settings.SYNC_HTTP_POOL_SIZE
+            session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+            _sessions[base_url] = session
+    return session
+
+
+def close_sessions():
+    """
+    Close all pooled connections, when the sync commands exit or e.g.
+    after forking a worker process
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
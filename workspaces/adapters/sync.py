@@ -1,7 +1,11 @@
+from .bulk import chunked
+
+
 class ModelSyncher(object):
 
     def __init__(self, queryset, generate_obj_id, delete_func=None,
-                 delete_limit=0.4, skip_delete=False):
+                 delete_limit=0.4, skip_delete=False, bulk_delete_func=None,
+                 bulk_chunk_size=1000):
         """
         Initialize a ModelSyncher.
 
@@ -9,6 +13,9 @@ class ModelSyncher(object):
         :param generate_obj_id: function that should generate same ids for "same" objects
         :param delete_func: function for de-persisting objects
         :param delete_limit: failsafe maximum fraction of objects to delete
+        :param bulk_delete_func: function for de-persisting objects given as
+            a queryset; if given, it is used instead of delete_func
+        :param bulk_chunk_size: maximum number of objects per bulk_delete_func call
         """
         d = {}
         self.generate_obj_id = generate_obj_id
@@ -19,8 +26,11 @@ class ModelSyncher(object):
             obj._changed = False
 
         self.obj_dict = d
+        self.queryset = queryset
         self.delete_limit = delete_limit
         self.delete_func = delete_func
+        self.bulk_delete_func = bulk_delete_func
+        self.bulk_chunk_size = bulk_chunk_size
         self.skip_delete = skip_delete
 
     def mark(self, obj):
@@ -65,9 +75,92 @@ class ModelSyncher(object):
             if len(delete_list) > 5 and len(delete_list) > max_delete_count:
                 raise Exception("Attempting to delete more than %d%% of total items" % int(self.delete_limit * 100))
 
+        if self.bulk_delete_func:
+            pks = [obj.pk for obj in delete_list]
+            for chunk in chunked(pks, self.bulk_chunk_size):
+                self.bulk_delete_func(self.queryset.filter(pk__in=chunk))
+            return
+
         for obj in delete_list:
             if self.delete_func:
                 self.delete_func(obj)
             else:
                 print("Deleting object %s" % obj)
                 obj.delete()
+
+
+class CompactModelSyncher(object):
+
+    def __init__(self, queryset, id_field, index_fields, bulk_delete_func=None,
+                 delete_limit=0.4, skip_delete=False, bulk_chunk_size=1000):
+        """
+        Initialize a CompactModelSyncher.
+
+        Unlike ModelSyncher, only a tuple of the primary key and the given
+        index fields is kept in memory for each object. Full objects are
+        loaded on demand with load().
+
+        :param queryset: Django queryset containing currently known objects
+        :param id_field: name of the field holding the synchronization id
+        :param index_fields: names of the fields to keep in the index
+        :param bulk_delete_func: function for de-persisting objects given as a queryset
+        :param delete_limit: failsafe maximum fraction of objects to delete
+        :param bulk_chunk_size: maximum number of objects per bulk_delete_func call
+        """
+        self.queryset = queryset
+        self.index = {}
+        for row in queryset.order_by().values_list(id_field, 'pk', *index_fields).iterator():
+            self.index[row[0]] = row[1:]
+        self.marked = set()
+        self.delete_limit = delete_limit
+        self.bulk_delete_func = bulk_delete_func
+        self.bulk_chunk_size = bulk_chunk_size
+        self.skip_delete = skip_delete
+
+    def mark(self, obj_id):
+        """
+        Mark object to be kept (ie. it still exists at source)
+
+        :param obj_id: synchronization id of the object
+        :raises Exception: if object has already been marked
+        """
+        if obj_id in self.marked:
+            raise Exception("Object %s already marked" % obj_id)
+        self.marked.add(obj_id)
+
+    def get(self, obj_id):
+        """
+        Get the index entry of an object per its synchronization id
+
+        :param obj_id: synchronization id of the object
+        :returns: tuple of the primary key and index fields or None
+        """
+        return self.index.get(obj_id, None)
+
+    def load(self, pks):
+        """
+        Load full objects
+
+        :param pks: primary keys of the objects to load
+        :returns: dict of django models keyed by primary key
+        """
+        if not pks:
+            return {}
+        return self.queryset.in_bulk(pks)
+
+    def finish(self):
+        """
+        Run synchronization, applying bulk_delete_func to items not mark():ed
+        """
+        if self.skip_delete:
+            return
+
+        delete_list = [entry[0] for obj_id, entry in self.index.items() if obj_id not in self.marked]
+
+        if self.delete_limit is not None:
+            max_delete_count = len(self.index) * self.delete_limit
+            if len(delete_list) > 5 and len(delete_list) > max_delete_count:
+                raise Exception("Attempting to delete more than %d%% of total items" % int(self.delete_limit * 100))
+
+        for chunk in chunked(delete_list, self.bulk_chunk_size):
+            self.bulk_delete_func(self.queryset.filter(pk__in=chunk))
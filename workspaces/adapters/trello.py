@@ -1,17 +1,34 @@
-import requests
+import datetime
 import logging
 import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
 from django.db import transaction
 from django.views.decorators.http import require_http_methods
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 from django.conf.urls import url
 from django.apps import apps
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from .base import Adapter
+from .bulk import DEFAULT_BATCH_SIZE, chunked
 
 logger = logging.getLogger(__name__)
 
+# Board actions that indicate a change in a card
+CARD_ACTION_TYPES = (
+    'createCard', 'updateCard', 'copyCard', 'moveCardToBoard', 'convertToCardFromCheckItem',
+    'addMemberToCard', 'removeMemberFromCard',
+)
+ACTIONS_PAGE_SIZE = 1000
+# If more cards than this have changed, fetch the whole board instead
+MAX_INCREMENTAL_CARDS = 20
+# Maximum number of API calls in one batch request
+BATCH_MAX_URLS = 10
+
 
 class TrelloAPIException(Exception):
     pass
@@ -23,19 +40,51 @@ class TrelloAdapter(Adapter):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    def get_rate_limit(self):
+        # Trello allows 100 requests per 10 seconds for each token
+        return (self.data_source.token, 100, 10)
+
+    def get_rate_limit_state(self, resp):
+        state = super().get_rate_limit_state(resp)
+        remaining = resp.headers.get('x-rate-limit-api-token-remaining', '')
+        interval = resp.headers.get('x-rate-limit-api-token-interval-ms', '')
+        if remaining.isdigit():
+            state['remaining'] = int(remaining)
+        if interval.isdigit():
+            # The window is not reported, so it may be reset earlier than this
+            state['reset_at'] = timezone.now() + datetime.timedelta(milliseconds=int(interval))
+        return state
+
     def api_get(self, path, **kwargs):
         url = self.API_BASE + path
         params = dict(key=self.data_source.key, token=self.data_source.token)
         params.update(kwargs)
-        resp = requests.get(url, params=params)
+        resp = self.http_request('get', url, params=params)
         assert resp.status_code == 200, "Trello API error: %s" % resp.content
         return resp.json()
 
+    def _start_api_get(self, executor, path, **kwargs):
+        """
+        Start a GET request in a thread of the given executor
+
+        :returns: function returning the parsed response
+        """
+        url = self.API_BASE + path
+        params = dict(key=self.data_source.key, token=self.data_source.token)
+        params.update(kwargs)
+        get_response = self.start_request(executor, 'get', url, params=params)
+
+        def read_response():
+            resp = get_response()
+            assert resp.status_code == 200, "Trello API error: %s" % resp.content
+            return resp.json()
+        return read_response
+
     def api_delete(self, path, **kwargs):
         url = self.API_BASE + path
         params = dict(key=self.data_source.key, token=self.data_source.token)
         params.update(kwargs)
-        resp = requests.delete(url, params=params)
+        resp = self.http_request('delete', url, params=params)
         assert resp.status_code == 200, "Trello API error: %s" % resp.content
         return resp.json()
 
@@ -50,7 +99,7 @@ class TrelloAdapter(Adapter):
         params.update(kwargs)
 
         post_kwargs['headers'] = {'Content-type': 'application/json'}
-        resp = requests.post(url, **post_kwargs)
+        resp = self.http_request('post', url, **post_kwargs)
         if resp.status_code != 200:
             raise TrelloAPIException("POST failed with %d: \"%s\"" % (
                 resp.status_code, resp.content.decode('utf8')
@@ -72,7 +121,7 @@ class TrelloAdapter(Adapter):
         return data
 
     def _import_user(self, user):
-        return dict(username=user['username'], origin_id=user['id'], full_name=user['fullName'])
+        return dict(username=user['username'], origin_id=user['id'], full_name=user.get('fullName'))
 
     def _import_card(self, card):
         if card['closed']:
@@ -119,36 +168,295 @@ class TrelloAdapter(Adapter):
             self.delete_webhook(origin_id)
             self.api_delete('tokens/{}/webhooks/{}'.format(self.data_source.token, origin_id))
 
-    def sync_tasks(self, workspace, origin_id=None):
+    def _get_changed_card_ids(self, workspace, since):
+        """
+        Return ids of cards on the board that have had activity since the
+        given time, or None if there are too many to fetch one by one.
+        """
+        actions = self.api_get('boards/{}/actions'.format(workspace.origin_id),
+                               since=since.isoformat(), filter=','.join(CARD_ACTION_TYPES),
+                               fields='data', limit=ACTIONS_PAGE_SIZE)
+        if len(actions) >= ACTIONS_PAGE_SIZE:
+            return None
+        card_ids = []
+        for action in actions:
+            card = action['data'].get('card')
+            if card and card['id'] not in card_ids:
+                card_ids.append(card['id'])
+        if len(card_ids) > MAX_INCREMENTAL_CARDS:
+            return None
+        return card_ids
+
+    def _import_card_pages(self, pages):
+        """
+        Convert pages of cards to task dicts, saving their members before
+        the tasks are yielded.
+        """
+        return self._import_pages(pages, lambda card: card['members'], self._import_user, self._import_card)
+
+    def _get_card(self, card_id):
+        """
+        Fetch a card with its members, or return None if it has been deleted
+        """
+        url = self.API_BASE + 'cards/{}'.format(card_id)
+        params = dict(key=self.data_source.key, token=self.data_source.token,
+                      member_fields='username,fullName', members='true')
+        resp = self.http_request('get', url, params=params)
+        if resp.status_code == 404:
+            return None
+        assert resp.status_code == 200, "Trello API error: %s" % resp.content
+        return resp.json()
+
+    def _iter_card_batches(self, card_ids, deleted=None):
+        """
+        Fetch cards with their members using the batch API, yielding the
+        cards of each batch request. Cards that could not be fetched are
+        left out.
+
+        :param deleted: list to which the ids of deleted cards are added
+        """
+        def start_batch(chunk):
+            # The member fields are left to their defaults, because commas
+            # would break the list of URLs.
+            urls = ','.join('/cards/{}?members=true'.format(card_id) for card_id in chunk)
+            return self._start_api_get(executor, 'batch', urls=urls)
+
+        chunks = list(chunked(card_ids, BATCH_MAX_URLS))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            read_batch = start_batch(chunks[0]) if chunks else None
+            for chunk, next_chunk in zip(chunks, chunks[1:] + [None]):
+                results = read_batch()
+                # The next batch is fetched while the cards of this one are handled
+                read_batch = start_batch(next_chunk) if next_chunk else None
+                cards = []
+                for card_id, result in zip(chunk, results):
+                    if '200' in result:
+                        cards.append(result['200'])
+                    elif '404' in result and deleted is not None:
+                        deleted.append(card_id)
+                    else:
+                        logger.warning('Fetching card %s failed: %s' % (card_id, result))
+                yield cards
+
+    def _get_members(self, member_ids):
+        """
+        Fetch members using the batch API. Members that could not be
+        fetched are left out.
+        """
+        members = []
+        for chunk in chunked(member_ids, BATCH_MAX_URLS):
+            urls = ','.join('/members/{}'.format(member_id) for member_id in chunk)
+            for member_id, result in zip(chunk, self.api_get('batch', urls=urls)):
+                if '200' in result:
+                    members.append(result['200'])
+                else:
+                    logger.warning('Fetching member %s failed: %s' % (member_id, result))
+        return members
+
+    def _close_deleted_cards(self, workspace, card_ids):
+        """
+        Close the tasks of cards that have been deleted from Trello
+        """
+        if not card_ids:
+            return Counter()
+        logger.info('Cards deleted from %s: %s' % (workspace, ', '.join(card_ids)))
+        existing = workspace.tasks.filter(origin_id__in=card_ids).values_list('origin_id', flat=True)
+        tasks = [dict(origin_id=card_id, state='closed') for card_id in existing]
+        return self._update_tasks(workspace, tasks, skip_delete=True)
+
+    def sync_selected_tasks(self, workspace, origin_ids):
+        """
+        Synchronize the given cards of a board, fetching up to ten of them
+        per request
+        """
+        deleted = []
+        pages = self._iter_card_batches(list(origin_ids), deleted)
+        stats = self._update_tasks(workspace, self._import_card_pages(pages), skip_delete=True)
+        stats.update(self._close_deleted_cards(workspace, deleted))
+        return stats
+
+    def _get_board_snapshot(self, board_id):
+        """
+        Fetch a board with all of its lists, cards and members in one request
+        """
+        return self.api_get('boards/{}'.format(board_id), fields='name', lists='all', cards='all',
+                            members='all', member_fields='username,fullName')
+
+    def sync_board(self, workspace):
+        """
+        Synchronize a board, its lists, members and cards from a single
+        snapshot of the board
+
+        Archived cards are included in the snapshot, and cards missing from
+        it are closed.
+        """
+        started_at = timezone.now()
+        board = self._get_board_snapshot(workspace.origin_id)
+        members = board['members']
+        # Cards keep the members who have since left the board, and the
+        # snapshot does not include them.
+        known_ids = set(member['id'] for member in members) | set(self.user_cache.get_users())
+        missing_ids = set(member_id for card in board['cards'] for member_id in card['idMembers']) - known_ids
+        if missing_ids:
+            members = members + self._get_members(sorted(missing_ids))
+        with self.metrics.phase('import'):
+            if members:
+                self.save_users([self._import_user(member) for member in members])
+            self._update_workspaces(self._import_board(board))
+            tasks = [self._import_card(card) for card in board['cards']]
+
+        stats = self._update_tasks(workspace, tasks)
+        self._set_sync_watermark(workspace, started_at)
+        return stats
+
+    def sync_tasks(self, workspace, origin_id=None, full=False):
         """
         Synchronize tasks between given workspace and its Trello source
         :param workspace: Workspace to be synced
         :param origin_id: Task id if only one task is to be synced
+        :param full: Fetch the whole board instead of the cards changed since last sync
         """
 
-        if not origin_id:
-            data = self.api_get('boards/{}/cards'.format(workspace.origin_id),
-                                member_fields='username,fullName', members='true')
+        started_at = timezone.now()
+        if origin_id:
+            card = self._get_card(origin_id)
+            if card is None:
+                return self._close_deleted_cards(workspace, [origin_id])
+            tasks = list(self._import_card_pages([[card]]))
+            return self._update_tasks(workspace, tasks[0])
+
+        since = self._get_sync_watermark(workspace, full)
+        if not since:
+            return self.sync_board(workspace)
+        card_ids = self._get_changed_card_ids(workspace, since)
+        deleted = []
+        if card_ids is not None:
+            pages = self._iter_card_batches(card_ids, deleted)
         else:
-            card = self.api_get('cards/{}'.format(origin_id),
+            # Archived cards need to be included as well, because we
+            # won't be closing missing tasks.
+            data = self.api_get('boards/{}/cards'.format(workspace.origin_id), filter='all',
                                 member_fields='username,fullName', members='true')
-            data = [card]
+            data = [card for card in data
+                    if parse_datetime(card['dateLastActivity']) >= since]
+            pages = chunked(data, DEFAULT_BATCH_SIZE)
 
-        tasks = [self._import_card(card) for card in data]
-        all_members = {}
-        for card in data:
-            for member in card['members']:
-                if member['id'] in all_members:
-                    continue
-                all_members[member['id']] = member
+        stats = self._update_tasks(workspace, self._import_card_pages(pages), skip_delete=True)
+        stats.update(self._close_deleted_cards(workspace, deleted))
+        self._set_sync_watermark(workspace, started_at)
+        return stats
 
-        users = [self._import_user(user) for user in all_members.values()]
-        self.save_users(users)
+    def _import_action_card(self, workspace, action):
+        """
+        Convert a card action to a (possibly partial) task dict, or return
+        None if the action does not describe the card well enough.
+        """
+        action_type = action['type']
+        data = action['data']
+        card = data['card']
+        task = dict(origin_id=card['id'], updated_at=action['date'])
+
+        if action_type == 'createCard':
+            task.update(name=card['name'], state='open', assigned_users=[],
+                        list_origin_id=data['list']['id'])
+            return task
+
+        existing = workspace.tasks.filter(origin_id=card['id']).first()
+        if existing is None:
+            return None
+
+        if action_type == 'updateCard':
+            task.update(self._import_card_changes(card))
+        elif action_type == 'deleteCard':
+            task['state'] = 'closed'
+        elif action_type in ('addMemberToCard', 'removeMemberFromCard'):
+            assigned_users = self._import_member_action(existing, action)
+            if assigned_users is None:
+                return None
+            task['assigned_users'] = assigned_users
+        else:
+            return None
 
-        if not origin_id:
-            self._update_tasks(workspace, tasks)
+        return task
+
+    def _import_card_changes(self, card):
+        """
+        Convert the changed fields of an updateCard action to task fields
+        """
+        changes = {}
+        if 'name' in card:
+            changes['name'] = card['name']
+        if 'pos' in card:
+            changes['position'] = card['pos']
+        if 'idList' in card:
+            changes['list_origin_id'] = card['idList']
+        if 'closed' in card:
+            changes['state'] = 'closed' if card['closed'] else 'open'
+        return changes
+
+    def _import_member_action(self, task, action):
+        """
+        Return the origin ids of the users assigned to `task` after a member
+        was added to or removed from the card, or None if the action does not
+        describe the member well enough.
+        """
+        member = action.get('member')
+        if not member or 'username' not in member:
+            return None
+        self.save_users([self._import_user(member)])
+        assigned = set(task.assigned_users.values_list('origin_id', flat=True))
+        if action['type'] == 'addMemberToCard':
+            assigned.add(member['id'])
         else:
-            self._update_tasks(workspace, tasks[0])
+            assigned.discard(member['id'])
+        return list(assigned)
+
+    def _import_action_list(self, action):
+        """
+        Convert a list action to a (possibly partial) list dict, or return
+        None if the action does not describe the list well enough.
+        """
+        if action['type'] not in ('createList', 'updateList'):
+            return None
+        lst = action['data']['list']
+        data = dict(origin_id=lst['id'])
+        if 'name' in lst:
+            data['name'] = lst['name']
+        if 'pos' in lst:
+            data['position'] = lst['pos']
+        if 'closed' in lst:
+            data['state'] = 'closed' if lst['closed'] else 'open'
+        elif action['type'] == 'createList':
+            data['state'] = 'open'
+        return data
+
+    def apply_action(self, workspace, action):
+        """
+        Apply the changes described by a webhook action without fetching
+        anything from Trello.
+
+        Actions older than the stored card are ignored, as Trello may
+        deliver them again or out of order.
+
+        :returns: True if the action was applied, False if a sync is needed
+        """
+        data = action['data']
+        if 'card' in data:
+            if self._is_outdated(workspace, data['card']['id'], action['date']):
+                logger.debug('Ignoring outdated %s action of card %s' % (action['type'], data['card']['id']))
+                return True
+            task = self._import_action_card(workspace, action)
+            if task is None:
+                return False
+            self._update_tasks(workspace, task)
+            return True
+        if 'list' in data:
+            lst = self._import_action_list(action)
+            if lst is None:
+                return False
+            self._update_workspace_lists(workspace, [lst], skip_delete=True)
+            return True
+        return False
 
     def get_workspace_view_url(self, workspace):
         return 'https://trello.com/b/%s' % workspace.origin_id
@@ -160,6 +468,10 @@ def handle_trello_event(event):
     board_id = event['model']['id']
     workspace = Workspace.objects.get(data_source__type='trello', origin_id=board_id)
     action = event['action']
+    adapter = workspace.data_source.adapter
+    if adapter.apply_action(workspace, action):
+        return HttpResponse()
+
     if 'card' in action['data']:
         card_id = action['data']['card']['id']
         workspace.schedule_task_sync(card_id)
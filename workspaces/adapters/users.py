@@ -0,0 +1,110 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.apps import apps
+
+from .bulk import bulk_upsert
+
+logger = logging.getLogger(__name__)
+
+_shared_caches = None
+_shared_caches_lock = threading.Lock()
+
+
+class DataSourceUserCache(object):
+    """
+    In-memory copy of the users of a data source
+
+    Saving users through the cache only writes the ones that are new or
+    have changed since they were loaded.
+    """
+    def __init__(self, data_source_id):
+        self.data_source_id = data_source_id
+        self.lock = threading.RLock()
+        self.users = None
+
+    def _get_model(self):
+        return apps.get_model(app_label='workspaces', model_name='DataSourceUser')
+
+    def load(self):
+        """
+        (Re)load the users from the database
+
+        :returns: dict of data source users keyed by origin id
+        """
+        DataSourceUser = self._get_model()
+        with self.lock:
+            users = DataSourceUser.objects.filter(data_source_id=self.data_source_id)
+            self.users = {u.origin_id: u for u in users}
+            return self.users
+
+    def get_users(self):
+        with self.lock:
+            if self.users is None:
+                self.load()
+            return self.users
+
+    def save(self, users):
+        """
+        Create or update data source users from imported data dicts
+
+        :param users: list of user dicts
+        :returns: number of users written
+        """
+        DataSourceUser = self._get_model()
+        field_names = set(f.name for f in DataSourceUser._meta.concrete_fields)
+
+        with self.lock:
+            cached = self.get_users()
+            changed = []
+            update_fields = set()
+            for user in users:
+                obj = cached.get(user['origin_id'])
+                if not obj:
+                    obj = DataSourceUser(data_source_id=self.data_source_id)
+                    logger.debug('Creating new data source user: %s' % user['origin_id'])
+                dirty = [name for name, value in user.items()
+                         if name in field_names and getattr(obj, name) != value]
+                if obj.id and not dirty:
+                    continue
+                for name in dirty:
+                    setattr(obj, name, user[name])
+                update_fields.update(dirty)
+                changed.append(obj)
+
+            if changed:
+                bulk_upsert(DataSourceUser, changed, ('data_source', 'origin_id'),
+                            update_fields=sorted(update_fields))
+                for obj in changed:
+                    cached[obj.origin_id] = obj
+            return len(changed)
+
+
+def get_shared_user_cache(data_source_id):
+    """
+    Return the user cache shared by the current multi-workspace sync, or
+    None if no such sync is running
+    """
+    with _shared_caches_lock:
+        if _shared_caches is None:
+            return None
+        if data_source_id not in _shared_caches:
+            _shared_caches[data_source_id] = DataSourceUserCache(data_source_id)
+        return _shared_caches[data_source_id]
+
+
+@contextmanager
+def shared_user_caches():
+    """
+    Share one user cache per data source between all adapters, in all
+    threads, while the block runs
+    """
+    global _shared_caches
+    with _shared_caches_lock:
+        _shared_caches = {}
+    try:
+        yield
+    finally:
+        with _shared_caches_lock:
+            _shared_caches = None
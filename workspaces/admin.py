@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import GitHubDataSource, Workspace, WorkspaceList, Task, DataSourceUser, TaskAssignment
+from .models import (
+    GitHubDataSource, Workspace, WorkspaceList, Task, DataSourceUser, TaskAssignment, SyncJob, SyncRun
+)
 
 
 @admin.register(GitHubDataSource)
@@ -30,3 +32,16 @@ class DataSourceUserAdmin(admin.ModelAdmin):
 @admin.register(TaskAssignment)
 class TaskAssignmentAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(SyncJob)
+class SyncJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'type', 'state', 'data_source', 'workspace', 'task_origin_id', 'attempts', 'run_after')
+    list_filter = ('state', 'type')
+
+
+@admin.register(SyncRun)
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'workspace', 'full', 'started_at', 'duration', 'http_requests', 'sql_queries',
+                    'tasks_created', 'tasks_updated', 'tasks_closed')
+    list_filter = ('full', 'data_source')
@@ -1,7 +1,7 @@
 import logging
 from dynamic_rest import serializers, viewsets
-from rest_framework import serializers as drf_serializers
-from .models import Task, Workspace, DataSource, DataSourceUser
+from rest_framework import permissions, serializers as drf_serializers
+from .models import Task, Workspace, DataSource, DataSourceUser, SyncRun
 from projects.api import ProjectSerializer
 
 all_views = []
@@ -111,3 +111,28 @@ class TaskViewSet(viewsets.DynamicModelViewSet):
             print("filtering")
             queryset = queryset.filter(assigned_users__user__uuid=user_filter)
         return queryset
+
+
+class SyncRunSerializer(serializers.DynamicModelSerializer):
+    data_source = serializers.DynamicRelationField(DataSourceSerializer)
+    workspace = serializers.DynamicRelationField(WorkspaceSerializer)
+
+    class Meta:
+        model = SyncRun
+        fields = [
+            'id', 'data_source', 'workspace', 'full', 'started_at', 'finished_at', 'duration', 'error',
+            'fetch_time', 'import_time', 'diff_time', 'write_time', 'finish_time',
+            'http_requests', 'http_bytes', 'sql_queries',
+            'tasks_created', 'tasks_updated', 'tasks_closed',
+        ]
+        read_only_fields = fields
+        name = 'sync_run'
+        plural_name = 'sync_run'
+
+
+@register_view
+class SyncRunViewSet(viewsets.DynamicModelViewSet):
+    queryset = SyncRun.objects.all()
+    serializer_class = SyncRunSerializer
+    http_method_names = ['get', 'head', 'options']
+    permission_classes = (permissions.IsAdminUser,)
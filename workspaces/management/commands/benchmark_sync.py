@@ -0,0 +1,155 @@
+import copy
+import datetime
+import json
+import random
+import subprocess
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from workspaces.adapters.base import Adapter
+from workspaces.adapters.metrics import SyncMetrics
+from workspaces.adapters.sync import ModelSyncher
+from workspaces.models import DataSource
+
+LISTS_PER_WORKSPACE = 10
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate_users(count):
+    return [dict(origin_id='bench-user%d' % i, username='user%d' % i) for i in range(count)]
+
+
+def generate_workspaces(count):
+    return [dict(origin_id='bench-ws%d' % i, name='Workspace %d' % i, description=None, state='open',
+                 lists=[dict(origin_id='bench-ws%d-list%d' % (i, j), name='List %d' % j,
+                             position=float(j), state='open') for j in range(LISTS_PER_WORKSPACE)])
+            for i in range(count)]
+
+
+def generate_tasks(workspace, count, users, rnd):
+    updated_at = timezone.now() - datetime.timedelta(days=1)
+    user_ids = [u['origin_id'] for u in users]
+    return [dict(
+        origin_id='bench-task%d' % i, name='Task %d' % i, state='open', position=float(i),
+        assigned_users=rnd.sample(user_ids, rnd.randint(0, 2)),
+        list_origin_id='%s-list%d' % (workspace.origin_id, rnd.randrange(LISTS_PER_WORKSPACE)),
+        updated_at=updated_at.isoformat(),
+    ) for i in range(count)]
+
+
+class Command(BaseCommand):
+    help = "Measure the speed of writing synced users, workspaces and tasks to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--sizes', dest='sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help="Numbers of tasks in the generated workspace")
+        parser.add_argument('-o', '--output', dest='output',
+                            help="Write the results as JSON to this file")
+        parser.add_argument('--seed', dest='seed', type=int, default=0,
+                            help="Seed for generating the data")
+
+    def measure(self, size, scenario, func):
+        """
+        Run one benchmark scenario
+
+        In the timing pass the wall time and phase timings are recorded. In
+        the profiling pass the SQL queries and the peak memory allocated
+        during the scenario are added to the same result, as counting them
+        slows the run down.
+        """
+        self.adapter.metrics = metrics = SyncMetrics()
+        if self.profiling:
+            result = self.results_by_scenario[(size, scenario)]
+            tracemalloc.start()
+            try:
+                with metrics.count_queries():
+                    func()
+                result['peak_memory_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+            finally:
+                tracemalloc.stop()
+            result['sql_queries'] = metrics.sql_queries
+            self.stdout.write("%7d %-22s %8.2f s %7d queries %8d kB peak memory" % (
+                size, scenario, result['seconds'], result['sql_queries'], result['peak_memory_kb']
+            ))
+            return
+
+        start = time.monotonic()
+        stats = func()
+        result = dict(
+            size=size, scenario=scenario, seconds=round(time.monotonic() - start, 3),
+            phases={phase: round(metrics.timings[phase], 3) for phase in metrics.PHASES},
+        )
+        for key in ('created', 'updated', 'closed'):
+            result[key] = (stats or {}).get(key, 0)
+        self.results.append(result)
+        self.results_by_scenario[(size, scenario)] = result
+
+    def run_size(self, size, seed):
+        # Both passes run the same scenarios on the same data. Everything
+        # created by the benchmark is rolled back after each pass.
+        for profiling in (False, True):
+            self.profiling = profiling
+            with transaction.atomic():
+                self.run_scenarios(size, random.Random('%d-%d' % (seed, size)))
+                transaction.set_rollback(True)
+
+    def run_scenarios(self, size, rnd):
+        data_source = DataSource.objects.create(type='benchmark', name='Sync benchmark')
+        self.adapter = adapter = Adapter(data_source)
+        users = generate_users(max(size // 100, 10))
+        workspaces = generate_workspaces(max(size // 1000, 1))
+        self.measure(size, 'users cold', lambda: adapter.save_users(users))
+        self.measure(size, 'users no-op', lambda: adapter.save_users(users))
+        self.measure(size, 'workspaces cold', lambda: adapter._update_workspaces(copy.deepcopy(workspaces)))
+        self.measure(size, 'workspaces no-op', lambda: adapter._update_workspaces(copy.deepcopy(workspaces)))
+
+        workspace = data_source.workspaces.get(origin_id=workspaces[0]['origin_id'])
+        tasks = generate_tasks(workspace, size, users, rnd)
+
+        def update_tasks(tasks):
+            # The task dicts are consumed while syncing, so each run
+            # gets its own copies, made before the timing starts.
+            tasks = copy.deepcopy(tasks)
+            return lambda: adapter._update_tasks(workspace, tasks)
+
+        self.measure(size, 'tasks cold', update_tasks(tasks))
+        self.measure(size, 'tasks no-op', update_tasks(tasks))
+
+        for task in rnd.sample(tasks, max(size // 100, 1)):
+            task['name'] += ' changed'
+        self.measure(size, 'tasks 1% changed', update_tasks(tasks))
+
+        def model_syncher():
+            syncher = ModelSyncher(workspace.tasks.all(), lambda task: task.origin_id, delete_limit=None,
+                                   bulk_delete_func=lambda queryset: queryset.update(state='closed'))
+            for task in tasks:
+                syncher.mark(syncher.get(task['origin_id']))
+            syncher.finish()
+        self.measure(size, 'model syncher no-op', model_syncher)
+
+        self.measure(size, 'tasks mass close', update_tasks(tasks[:size // 2]))
+
+    def handle(self, *args, **options):
+        self.results = []
+        self.results_by_scenario = {}
+        for size in options['sizes']:
+            self.run_size(size, options['seed'])
+
+        if options['output']:
+            report = dict(
+                revision=get_git_revision(), database=connection.vendor,
+                created_at=timezone.now().isoformat(), results=self.results,
+            )
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS("Results written to %s" % options['output']))
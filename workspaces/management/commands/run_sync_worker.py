@@ -0,0 +1,71 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, InterfaceError, close_old_connections
+from workspaces.adapters.session import close_sessions
+from workspaces.models import HTTPCacheEntry, SyncJob
+
+logger = logging.getLogger(__name__)
+
+# Seconds between deleting old finished jobs and cached responses
+PRUNE_INTERVAL = 600
+
+
+class Command(BaseCommand):
+    help = "Run queued workspace and task sync jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--burst', dest='burst', action='store_true',
+                            help="Exit when there are no more runnable jobs")
+        parser.add_argument('-i', '--interval', dest='interval', type=float, default=2,
+                            help="Seconds to wait before polling an empty queue again")
+
+    def prune(self):
+        try:
+            deleted = SyncJob.prune()
+            deleted_responses = HTTPCacheEntry.prune()
+        except (DatabaseError, InterfaceError):
+            logger.exception("Deleting finished sync jobs and cached responses failed")
+            return
+        if deleted:
+            logger.info("Deleted %d finished sync jobs" % deleted)
+        if deleted_responses:
+            logger.info("Deleted %d unused cached responses" % deleted_responses)
+
+    def handle(self, *args, **options):
+        try:
+            self.run_jobs(options)
+        finally:
+            close_sessions()
+
+    def run_jobs(self, options):
+        last_prune = None
+        while True:
+            # The worker runs for long, so connections dropped by the
+            # database or past their CONN_MAX_AGE need to be replaced.
+            close_old_connections()
+            try:
+                job = SyncJob.claim()
+            except (DatabaseError, InterfaceError):
+                logger.exception("Claiming a sync job failed, retrying in %.1f s" % options['interval'])
+                time.sleep(options['interval'])
+                continue
+            if job is None:
+                if last_prune is None or time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                    self.prune()
+                    last_prune = time.monotonic()
+                if options['burst']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write("Running %s (attempt %d): " % (job, job.attempts), ending='')
+            start = time.monotonic()
+            try:
+                job.run()
+            except Exception:
+                logger.exception("Sync job %d failed" % job.id)
+                self.stdout.write(self.style.ERROR("failed, %s" % job.state))
+                continue
+            self.stdout.write(self.style.SUCCESS("done in %.1f s" % (time.monotonic() - start)))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from workspaces.models import SyncRun
+
+
+class Command(BaseCommand):
+    help = "Show timings and counters of recent task syncs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--limit', dest='limit', type=int, default=20,
+                            help="Number of sync runs to show")
+        parser.add_argument('-w', '--workspace', dest='workspace', type=int, action='append',
+                            help="Only show runs of the workspace with this ID")
+        parser.add_argument('-d', '--data-source', dest='data_source', type=int, action='append',
+                            help="Only show runs of workspaces of the data source with this ID")
+        parser.add_argument('--failed', dest='failed', action='store_true',
+                            help="Only show failed runs")
+
+    def handle(self, *args, **options):
+        runs = SyncRun.objects.select_related('workspace')
+        if options['workspace']:
+            runs = runs.filter(workspace__in=options['workspace'])
+        if options['data_source']:
+            runs = runs.filter(data_source__in=options['data_source'])
+        if options['failed']:
+            runs = runs.filter(error__isnull=False)
+
+        self.stdout.write("%-19s %-30s %8s %7s %7s %7s %7s %7s %6s %9s %6s %7s %7s %7s" % (
+            'started', 'workspace', 'total', 'fetch', 'import', 'diff', 'write', 'finish',
+            'reqs', 'kbytes', 'sql', 'created', 'updated', 'closed'
+        ))
+        for run in runs[:options['limit']]:
+            line = "%-19s %-30s %8.1f %7.1f %7.1f %7.1f %7.1f %7.1f %6d %9d %6d %7d %7d %7d" % (
+                run.started_at.strftime('%Y-%m-%d %H:%M:%S'), str(run.workspace)[:30], run.duration or 0,
+                run.fetch_time, run.import_time, run.diff_time, run.write_time, run.finish_time,
+                run.http_requests, run.http_bytes // 1024, run.sql_queries,
+                run.tasks_created, run.tasks_updated, run.tasks_closed
+            )
+            if run.error:
+                self.stdout.write(self.style.ERROR(line + "  " + run.error))
+            else:
+                self.stdout.write(line)
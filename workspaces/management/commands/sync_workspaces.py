@@ -0,0 +1,174 @@
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from workspaces.adapters.session import close_sessions
+from workspaces.adapters.users import shared_user_caches
+from workspaces.models import DataSource, HTTPCacheEntry, Workspace
+
+DEFAULT_MAX_PER_SOURCE = 2
+
+
+def sync_workspace(workspace_id, full):
+    """
+    Sync the tasks of a single workspace in a worker thread
+
+    :returns: tuple of (duration in seconds, Counter of changed rows, error message)
+    """
+    start = time.monotonic()
+    try:
+        workspace = Workspace.objects.select_related('data_source').get(id=workspace_id)
+        stats = workspace.sync_tasks(full=full)
+        return time.monotonic() - start, stats or Counter(), None
+    except Exception as e:
+        return time.monotonic() - start, Counter(), '%s: %s' % (type(e).__name__, e)
+    finally:
+        connection.close()
+
+
+def sync_data_source(data_source_id, full):
+    """
+    Sync the tasks of all workspaces of a data source in a worker thread
+
+    :returns: tuple of (duration in seconds, Counter of changed rows, error message)
+    """
+    start = time.monotonic()
+    try:
+        data_source = DataSource.objects.get(id=data_source_id)
+        stats = data_source.sync_tasks(full=full)
+        return time.monotonic() - start, stats or Counter(), None
+    except Exception as e:
+        return time.monotonic() - start, Counter(), '%s: %s' % (type(e).__name__, e)
+    finally:
+        connection.close()
+
+
+def next_sync(queue, running_per_source, max_per_source, get_source):
+    """
+    Remove and return the first item in the queue whose data source has
+    capacity left, or None if there is none
+    """
+    for item in queue:
+        if max_per_source is None or running_per_source[get_source(item)] < max_per_source:
+            queue.remove(item)
+            return item
+    return None
+
+
+def run_syncs(queue, sync, get_source, workers, max_per_source=None, deadline=None):
+    """
+    Run syncs of the queued items in worker threads
+
+    At most `max_per_source` items of one data source are synced at the
+    same time, and no syncs are started after the deadline. The items that
+    were not started are left in the queue.
+
+    :param sync: function syncing an item, returning a tuple of (duration
+        in seconds, Counter of changed rows, error message)
+    :param get_source: function returning the data source id of an item
+    :param deadline: time.monotonic() value after which no syncs are started
+    :returns: list of (item, duration, stats, error) tuples
+    """
+    running = {}
+    running_per_source = defaultdict(int)
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while queue or running:
+            out_of_time = deadline is not None and time.monotonic() >= deadline
+            while queue and not out_of_time and len(running) < workers:
+                item = next_sync(queue, running_per_source, max_per_source, get_source)
+                if item is None:
+                    break
+                running_per_source[get_source(item)] += 1
+                running[executor.submit(sync, item)] = item
+
+            if not running:
+                break
+            done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = running.pop(future)
+                running_per_source[get_source(item)] -= 1
+                results.append((item,) + future.result())
+    return results
+
+
+class Command(BaseCommand):
+    help = "Synchronize tasks of sync-enabled workspaces in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', dest='workers', type=int, default=4,
+                            help="Number of workspaces synced at the same time")
+        parser.add_argument('-s', '--max-per-source', dest='max_per_source', type=int,
+                            help="Maximum number of workspaces of one data source synced at the same time "
+                                 "(default %d)" % DEFAULT_MAX_PER_SOURCE)
+        parser.add_argument('-b', '--budget', dest='budget', type=float, metavar='SECONDS',
+                            help="Do not start new syncs after this many seconds")
+        parser.add_argument('-d', '--data-source', dest='data_source', type=int, action='append',
+                            help="Only sync workspaces of the data source with this ID")
+        parser.add_argument('--full', dest='full', action='store_true',
+                            help="Run full reconciliation instead of incremental syncs")
+        parser.add_argument('--by-source', dest='by_source', action='store_true',
+                            help="Sync all workspaces of a data source together, using "
+                                 "organization-wide requests where supported")
+
+    def handle_by_source(self, workspaces, options, deadline):
+        data_sources = {ws.data_source_id: ws.data_source for ws in workspaces}
+        queue = [data_sources[ds_id] for ds_id in sorted(data_sources)]
+        start = time.monotonic()
+        with shared_user_caches():
+            results = run_syncs(queue, lambda ds: sync_data_source(ds.id, options['full']),
+                                lambda ds: ds.id, options['workers'], deadline=deadline)
+        self.report(results, queue, start, 'data sources')
+
+    def report(self, results, skipped, start, noun='workspaces'):
+        """
+        Write the results of the finished syncs, the skipped ones and a summary
+        """
+        total = Counter()
+        for ws, duration, stats, error in results:
+            if error:
+                self.stdout.write(self.style.ERROR("%s: failed after %.1f s: %s" % (ws, duration, error)))
+                continue
+            total.update(stats)
+            self.stdout.write("%s: %.1f s, %d created, %d updated, %d closed" % (
+                ws, duration, stats['created'], stats['updated'], stats['closed']
+            ))
+        for ws in skipped:
+            self.stdout.write(self.style.WARNING("%s: skipped, time budget exceeded" % ws))
+
+        failed = len([r for r in results if r[3]])
+        self.stdout.write(self.style.SUCCESS(
+            "Synced %d %s in %.1f s (%d failed, %d skipped): %d created, %d updated, %d closed" % (
+                len(results) - failed, noun, time.monotonic() - start, failed, len(skipped),
+                total['created'], total['updated'], total['closed']
+            )
+        ))
+
+    def handle(self, *args, **options):
+        if options['by_source'] and options['max_per_source'] is not None:
+            raise CommandError("--max-per-source cannot be used with --by-source")
+        workspaces = Workspace.objects.filter(sync=True).select_related('data_source')
+        if options['data_source']:
+            workspaces = workspaces.filter(data_source__in=options['data_source'])
+        queue = list(workspaces)
+        if not queue:
+            self.stdout.write(self.style.WARNING("No sync-enabled workspaces"))
+            return
+        start = time.monotonic()
+        deadline = start + options['budget'] if options['budget'] is not None else None
+        try:
+            if options['by_source']:
+                self.handle_by_source(queue, options, deadline)
+            else:
+                # Users are shared by the workspaces of a data source, so they are
+                # cached and written once for the whole run.
+                with shared_user_caches():
+                    results = run_syncs(queue, lambda ws: sync_workspace(ws.id, options['full']),
+                                        lambda ws: ws.data_source_id, options['workers'],
+                                        options['max_per_source'] or DEFAULT_MAX_PER_SOURCE, deadline)
+                self.report(results, queue, start)
+            HTTPCacheEntry.prune()
+        finally:
+            close_sessions()
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workspaces', '0011_increment_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workspace',
+            name='tasks_synced_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workspaces', '0012_add_workspace_tasks_synced_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HTTPCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, max_length=40)),
+                ('url', models.TextField()),
+                ('etag', models.CharField(blank=True, max_length=200, null=True)),
+                ('last_modified', models.CharField(blank=True, max_length=100, null=True)),
+                ('links', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                ('body', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('data_source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='http_cache_entries', to='workspaces.DataSource')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='httpcacheentry',
+            unique_together=set([('data_source', 'key')]),
+        ),
+    ]
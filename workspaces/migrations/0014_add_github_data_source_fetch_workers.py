@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workspaces', '0013_add_http_cache_entry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='githubdatasource',
+            name='fetch_workers',
+            field=models.PositiveSmallIntegerField(default=4, help_text='Maximum number of API pages fetched in parallel'),
+        ),
+    ]
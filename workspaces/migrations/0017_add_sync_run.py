@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workspaces', '0016_add_fingerprints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('full', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField(db_index=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('fetch_time', models.FloatField(default=0, help_text='seconds spent in HTTP requests')),
+                ('import_time', models.FloatField(default=0, help_text='seconds spent converting API responses')),
+                ('diff_time', models.FloatField(default=0, help_text='seconds spent comparing tasks to stored ones')),
+                ('write_time', models.FloatField(default=0, help_text='seconds spent writing changed tasks')),
+                ('finish_time', models.FloatField(default=0, help_text='seconds spent closing removed tasks')),
+                ('http_requests', models.PositiveIntegerField(default=0)),
+                ('http_bytes', models.BigIntegerField(default=0)),
+                ('sql_queries', models.PositiveIntegerField(default=0)),
+                ('tasks_created', models.PositiveIntegerField(default=0)),
+                ('tasks_updated', models.PositiveIntegerField(default=0)),
+                ('tasks_closed', models.PositiveIntegerField(default=0)),
+                ('data_source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_runs', to='workspaces.DataSource')),
+                ('workspace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_runs', to='workspaces.Workspace')),
+            ],
+            options={
+                'ordering': ('-started_at',),
+                'get_latest_by': 'started_at',
+            },
+        ),
+    ]
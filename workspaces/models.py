@@ -1,5 +1,12 @@
+import datetime
+import hashlib
+import json
+import re
+from urllib.parse import parse_qs, urlsplit
+
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 from django.contrib.postgres.fields import JSONField
@@ -7,6 +14,7 @@ from django.contrib.postgres.fields import JSONField
 from projects.models import Project
 from projects.models.utils import TimestampedModel
 from .adapters import GitHubAdapter, TrelloAdapter
+from .adapters.metrics import SyncMetrics
 
 
 class TaskState:
@@ -55,9 +63,12 @@ class DataSource(models.Model):
         adapter = self.adapter
         adapter.sync_data_source()
 
+    def sync_tasks(self, full=False):
+        adapter = self.adapter
+        return adapter.sync_all_tasks(full=full)
+
     def schedule_workspace_sync(self):
-        # Convert to async later
-        self.sync_workspaces()
+        return SyncJob.enqueue(SyncJob.TYPE_WORKSPACES, data_source=self)
 
 
 class GitHubDataSource(DataSource):
@@ -70,6 +81,9 @@ class GitHubDataSource(DataSource):
     client_secret = models.CharField(max_length=100, blank=True, null=True)
     token = models.CharField(max_length=100, blank=True, null=True)
     organization = models.CharField(_('GitHub organization ID'), max_length=100)
+    fetch_workers = models.PositiveSmallIntegerField(
+        default=4, help_text=_('Maximum number of API pages fetched in parallel')
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -178,6 +192,12 @@ class Workspace(TimestampedModel):
     default_list_task_state = models.CharField(help_text=_('The default task state for new lists'),
                                                max_length=20, choices=TaskState.choices,
                                                null=True, blank=True)
+    # Start time of the last successful task sync, used for incremental syncs
+    tasks_synced_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Next page to fetch if the last task sync was interrupted
+    sync_checkpoint = JSONField(null=True, blank=True, editable=False)
+    # Hash of the data last imported from the source
+    fingerprint = models.CharField(max_length=40, null=True, blank=True, editable=False)
 
     objects = WorkspaceQuerySet.as_manager()
 
@@ -197,18 +217,44 @@ class Workspace(TimestampedModel):
         self.state = new_state
         self.save(update_fields=['state'])
 
-    def sync_tasks(self):
+    def sync_tasks(self, full=False):
+        adapter = self.data_source.adapter
+        adapter.metrics = metrics = SyncMetrics()
+        run = SyncRun(data_source_id=self.data_source_id, workspace=self, full=full, started_at=timezone.now())
+        stats = None
+        try:
+            with metrics.count_queries():
+                stats = adapter.sync_tasks(self, full=full)
+        except Exception as e:
+            run.set_error(e)
+            raise
+        finally:
+            run.finished_at = timezone.now()
+            run.set_metrics(metrics, stats)
+            run.save()
+        return stats
+
+    def sync_task(self, task_origin_id):
         adapter = self.data_source.adapter
-        adapter.sync_tasks(self)
+        return adapter.sync_tasks(self, task_origin_id)
 
-    def schedule_task_sync(self, task_origin_id):
+    def sync_selected_tasks(self, task_origin_ids):
         adapter = self.data_source.adapter
-        adapter.sync_tasks(self, task_origin_id)
+        return adapter.sync_selected_tasks(self, task_origin_ids)
 
-    def schedule_sync(self):
+    def sync_workspace(self):
         adapter = self.data_source.adapter
         adapter.sync_workspaces(self.origin_id)
 
+    def schedule_task_sync(self, task_origin_id):
+        return SyncJob.enqueue(SyncJob.TYPE_TASK, workspace=self, task_origin_id=task_origin_id)
+
+    def schedule_tasks_sync(self, full=False):
+        return SyncJob.enqueue(SyncJob.TYPE_TASKS, workspace=self, full=full)
+
+    def schedule_sync(self):
+        return SyncJob.enqueue(SyncJob.TYPE_WORKSPACE, workspace=self)
+
     def get_external_view_url(self):
         adapter = self.data_source.adapter
         return adapter.get_workspace_view_url(self)
@@ -252,6 +298,8 @@ class Task(models.Model):
                                             blank=True)
 
     extra_data = JSONField(null=True, blank=True)
+    # Hash of the data last imported from the source
+    fingerprint = models.CharField(max_length=40, null=True, blank=True, editable=False)
 
     objects = TaskQuerySet.as_manager()
 
@@ -320,6 +368,8 @@ class WorkspaceList(TimestampedModel):
     # If being on this list makes tasks open or closed, task_state
     # is set accordingly.
     task_state = models.CharField(max_length=10, choices=TaskState.choices, null=True)
+    # Hash of the data last imported from the source
+    fingerprint = models.CharField(max_length=40, null=True, blank=True, editable=False)
 
     objects = WorkspaceListQuerySet.as_manager()
 
@@ -352,3 +402,343 @@ class DataSourceWebhook(models.Model):
 
     class Meta:
         unique_together = [('data_source', 'origin_id')]
+
+
+class HTTPCacheEntry(models.Model):
+    """
+    Validators and parsed body of a previously fetched API response, used
+    for making conditional requests.
+    """
+    data_source = models.ForeignKey(DataSource, related_name='http_cache_entries', on_delete=models.CASCADE)
+    key = models.CharField(max_length=40, db_index=True)
+    url = models.TextField()
+    etag = models.CharField(max_length=200, null=True, blank=True)
+    last_modified = models.CharField(max_length=100, null=True, blank=True)
+    links = JSONField(null=True, blank=True)
+    body = JSONField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    # Requests with these query parameters change on every sync, so their
+    # responses would never be reused
+    UNCACHED_PARAMS = ('since',)
+
+    def __str__(self):
+        return 'Cached response for {} ({})'.format(self.url, self.data_source)
+
+    @classmethod
+    def make_key(cls, url, params=None):
+        """
+        Generate a cache key from a request URL and its query parameters
+
+        :returns: the key, or None if the response should not be cached
+        """
+        names = set(params or {}) | set(parse_qs(urlsplit(url).query))
+        if names.intersection(cls.UNCACHED_PARAMS):
+            return None
+        params = sorted((params or {}).items())
+        return hashlib.sha1(json.dumps([url, params]).encode('utf8')).hexdigest()
+
+    @classmethod
+    def prune(cls, data_source=None):
+        """
+        Delete the entries that have not been used in SYNC_HTTP_CACHE_MAX_AGE
+        seconds
+
+        :param data_source: only delete the entries of this data source
+        :returns: number of deleted entries
+        """
+        cutoff = timezone.now() - datetime.timedelta(seconds=settings.SYNC_HTTP_CACHE_MAX_AGE)
+        entries = cls.objects.filter(updated_at__lt=cutoff)
+        if data_source is not None:
+            entries = entries.filter(data_source=data_source)
+        deleted, _ = entries.delete()
+        return deleted
+
+    def touch(self):
+        """
+        Mark the entry as used, at most once a day to keep cache hits cheap
+        """
+        now = timezone.now()
+        if self.updated_at < now - datetime.timedelta(days=1):
+            HTTPCacheEntry.objects.filter(pk=self.pk).update(updated_at=now)
+            self.updated_at = now
+
+    class Meta:
+        unique_together = [('data_source', 'key')]
+
+
+class RateLimitBucket(models.Model):
+    """
+    Request tokens left for one API credential, shared by all sync workers
+    """
+    key = models.CharField(max_length=40, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.DateTimeField()
+    blocked_until = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return 'Rate limit bucket {} ({:.1f} tokens)'.format(self.key, self.tokens)
+
+
+class SyncJobQuerySet(models.QuerySet):
+    def pending(self):
+        return self.filter(state='pending')
+
+    def failed(self):
+        return self.filter(state='failed')
+
+
+class SyncJob(models.Model):
+    """
+    A queued synchronization to be run by a sync worker
+    """
+    TYPE_WORKSPACES = 'workspaces'
+    TYPE_WORKSPACE = 'workspace'
+    TYPE_TASKS = 'tasks'
+    TYPE_TASK = 'task'
+
+    TYPES = (
+        (TYPE_WORKSPACES, _('all workspaces of a data source')),
+        (TYPE_WORKSPACE, _('single workspace')),
+        (TYPE_TASKS, _('all tasks of a workspace')),
+        (TYPE_TASK, _('single task')),
+    )
+
+    STATE_PENDING = 'pending'
+    STATE_RUNNING = 'running'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+
+    STATES = (
+        (STATE_PENDING, _('pending')),
+        (STATE_RUNNING, _('running')),
+        (STATE_DONE, _('done')),
+        (STATE_FAILED, _('failed')),
+    )
+
+    type = models.CharField(max_length=20, choices=TYPES)
+    state = models.CharField(max_length=10, choices=STATES, db_index=True, default=STATE_PENDING)
+    data_source = models.ForeignKey(DataSource, related_name='sync_jobs', on_delete=models.CASCADE)
+    workspace = models.ForeignKey(Workspace, related_name='sync_jobs', null=True, blank=True,
+                                  on_delete=models.CASCADE)
+    task_origin_id = models.CharField(max_length=100, null=True, blank=True)
+    full = models.BooleanField(default=False)
+
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+
+    objects = SyncJobQuerySet.as_manager()
+
+    # Other single-task jobs of the same workspace run along with this one
+    merged_jobs = ()
+
+    def __str__(self):
+        target = self.workspace or self.data_source
+        if self.task_origin_id:
+            return '{} sync for {} #{} ({})'.format(self.type, target, self.task_origin_id, self.state)
+        return '{} sync for {} ({})'.format(self.type, target, self.state)
+
+    @classmethod
+    def enqueue(cls, type, data_source=None, workspace=None, task_origin_id=None, full=False):
+        """
+        Add a job to the queue, coalescing it with a matching pending job
+
+        New jobs become runnable after SYNC_JOB_DEBOUNCE seconds, so that
+        a burst of webhook events for the same target results in a single
+        sync. If too many tasks of one workspace are waiting to be synced,
+        they are replaced by a single sync of the workspace's tasks.
+
+        :returns: the new or the already pending job
+        """
+        if data_source is None:
+            data_source = workspace.data_source
+
+        with transaction.atomic():
+            # Serialize enqueuing per data source so that concurrent
+            # webhook requests don't create duplicate jobs.
+            DataSource.objects.select_for_update().filter(pk=data_source.pk).first()
+
+            pending = cls.objects.pending().filter(data_source=data_source, workspace=workspace)
+            job = pending.filter(type=type, task_origin_id=task_origin_id, full=full).first()
+            if job is not None:
+                return job
+
+            if type == cls.TYPE_TASK:
+                # A pending sync of all the tasks will cover this one too
+                job = pending.filter(type=cls.TYPE_TASKS).first()
+                if job is not None:
+                    return job
+                task_jobs = pending.filter(type=cls.TYPE_TASK)
+                if task_jobs.count() + 1 >= settings.SYNC_JOB_ESCALATE_THRESHOLD:
+                    run_after = task_jobs.aggregate(models.Min('run_after'))['run_after__min']
+                    task_jobs.delete()
+                    return cls.objects.create(type=cls.TYPE_TASKS, data_source=data_source,
+                                              workspace=workspace, run_after=run_after)
+
+            run_after = timezone.now() + datetime.timedelta(seconds=settings.SYNC_JOB_DEBOUNCE)
+            return cls.objects.create(type=type, data_source=data_source, workspace=workspace,
+                                      task_origin_id=task_origin_id, full=full, run_after=run_after)
+
+    @classmethod
+    def claim(cls):
+        """
+        Claim the next runnable job for this worker
+
+        Jobs locked by other workers are skipped, so any number of workers
+        can claim jobs concurrently. Jobs that have been running for longer
+        than SYNC_JOB_TIMEOUT are assumed to belong to a dead worker and
+        are claimed again.
+
+        Single-task jobs claim the other runnable single-task jobs of their
+        workspace as well, so that the tasks can be fetched together.
+
+        :returns: the claimed job or None if there is nothing to run
+        """
+        now = timezone.now()
+        stale = now - datetime.timedelta(seconds=settings.SYNC_JOB_TIMEOUT)
+        runnable = Q(state=cls.STATE_PENDING, run_after__lte=now) | Q(state=cls.STATE_RUNNING, started_at__lt=stale)
+        with transaction.atomic():
+            job = cls.objects.select_for_update(skip_locked=True).filter(runnable).order_by('run_after', 'id').first()
+            if job is None:
+                return None
+            jobs = [job]
+            if job.type == cls.TYPE_TASK:
+                job.merged_jobs = list(cls.objects.select_for_update(skip_locked=True).filter(
+                    runnable, type=cls.TYPE_TASK, workspace=job.workspace_id
+                ).exclude(pk=job.pk))
+                jobs += job.merged_jobs
+            for claimed in jobs:
+                claimed.state = cls.STATE_RUNNING
+                claimed.attempts += 1
+                claimed.started_at = now
+                claimed.save(update_fields=['state', 'attempts', 'started_at'])
+        return job
+
+    @classmethod
+    def prune(cls):
+        """
+        Delete the jobs that finished more than SYNC_JOB_RETENTION seconds ago
+
+        :returns: number of deleted jobs
+        """
+        cutoff = timezone.now() - datetime.timedelta(seconds=settings.SYNC_JOB_RETENTION)
+        deleted, _ = cls.objects.filter(state=cls.STATE_DONE, finished_at__lt=cutoff).delete()
+        return deleted
+
+    def execute(self):
+        if self.type == self.TYPE_WORKSPACES:
+            self.data_source.sync_workspaces()
+        elif self.type == self.TYPE_WORKSPACE:
+            self.workspace.sync_workspace()
+        elif self.type == self.TYPE_TASKS:
+            self.workspace.sync_tasks(full=self.full)
+        elif self.type == self.TYPE_TASK and self.merged_jobs:
+            task_origin_ids = [self.task_origin_id] + [job.task_origin_id for job in self.merged_jobs]
+            self.workspace.sync_selected_tasks(task_origin_ids)
+        elif self.type == self.TYPE_TASK:
+            self.workspace.sync_task(self.task_origin_id)
+        else:
+            raise NotImplementedError('Unknown sync job type: {}'.format(self.type))
+
+    def run(self):
+        """
+        Run a claimed job, rescheduling it with exponential backoff if it fails
+        """
+        jobs = [self] + list(self.merged_jobs)
+        try:
+            self.execute()
+        except Exception as e:
+            for job in jobs:
+                job.last_error = '{}: {}'.format(type(e).__name__, e)
+                if job.attempts >= settings.SYNC_JOB_MAX_ATTEMPTS:
+                    job.state = self.STATE_FAILED
+                else:
+                    job.state = self.STATE_PENDING
+                    delay = settings.SYNC_JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+                    job.run_after = timezone.now() + datetime.timedelta(seconds=delay)
+                job.save(update_fields=['state', 'run_after', 'last_error'])
+            raise
+
+        finished_at = timezone.now()
+        SyncJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            state=self.STATE_DONE, finished_at=finished_at
+        )
+        for job in jobs:
+            job.state = self.STATE_DONE
+            job.finished_at = finished_at
+
+    class Meta:
+        ordering = ('run_after', 'id')
+
+
+# Query string of a URL in an error message
+QUERY_STRING_RE = re.compile(r'\?[^\s\'"()]*')
+
+
+class SyncRun(models.Model):
+    """
+    Timings and counters of one task sync of a workspace
+    """
+    data_source = models.ForeignKey(DataSource, related_name='sync_runs', on_delete=models.CASCADE)
+    workspace = models.ForeignKey(Workspace, related_name='sync_runs', on_delete=models.CASCADE)
+    full = models.BooleanField(default=False)
+    started_at = models.DateTimeField(db_index=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    fetch_time = models.FloatField(default=0, help_text=_('seconds spent in HTTP requests'))
+    import_time = models.FloatField(default=0, help_text=_('seconds spent converting API responses'))
+    diff_time = models.FloatField(default=0, help_text=_('seconds spent comparing tasks to stored ones'))
+    write_time = models.FloatField(default=0, help_text=_('seconds spent writing changed tasks'))
+    finish_time = models.FloatField(default=0, help_text=_('seconds spent closing removed tasks'))
+
+    http_requests = models.PositiveIntegerField(default=0)
+    http_bytes = models.BigIntegerField(default=0)
+    sql_queries = models.PositiveIntegerField(default=0)
+    tasks_created = models.PositiveIntegerField(default=0)
+    tasks_updated = models.PositiveIntegerField(default=0)
+    tasks_closed = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return 'Sync of {} at {}'.format(self.workspace, self.started_at)
+
+    @property
+    def duration(self):
+        if not self.finished_at:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    def set_metrics(self, metrics, stats=None):
+        """
+        Copy the collected metrics and row counts to this run
+
+        :param metrics: SyncMetrics collected during the sync
+        :param stats: Counter of created, updated and closed tasks
+        """
+        for phase in metrics.PHASES:
+            setattr(self, '{}_time'.format(phase), metrics.timings[phase])
+        self.http_requests = metrics.http_requests
+        self.http_bytes = metrics.http_bytes
+        self.sql_queries = metrics.sql_queries
+        if stats:
+            self.tasks_created = stats['created']
+            self.tasks_updated = stats['updated']
+            self.tasks_closed = stats['closed']
+
+    def set_error(self, exc):
+        """
+        Record the exception that failed the sync
+
+        Query strings are left out of the message, as the URLs of failed
+        requests may carry API credentials.
+        """
+        message = '{}: {}'.format(type(exc).__name__, exc)
+        self.error = QUERY_STRING_RE.sub('', message)
+
+    class Meta:
+        ordering = ('-started_at',)
+        get_latest_by = 'started_at'
@@ -1,9 +1,12 @@
+import datetime
+
 import pytest
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 
+from workspaces.adapters.fake import FakeGitHub, FakeTrello
 from workspaces.models import (
-    DataSource, DataSourceUser, Workspace, Task, TaskAssignment
+    DataSource, DataSourceUser, GitHubDataSource, Workspace, Task, TaskAssignment, TrelloDataSource
 )
 
 
@@ -67,7 +70,8 @@ def data_source_user(data_source, user):
 @pytest.fixture
 def task(workspace):
     return Task.objects.create(
-        workspace=workspace, origin_id='task1', state='open'
+        workspace=workspace, origin_id='task1', state='open',
+        updated_at=datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
     )
 
 
@@ -75,3 +79,59 @@ def task(workspace):
 @pytest.fixture
 def task_assignment(task, data_source_user):
     return TaskAssignment.objects.create(task=task, user=data_source_user)
+
+
+@pytest.mark.django_db
+@pytest.fixture
+def github_data_source(request):
+    options = dict(name='GitHub', organization='org', fetch_workers=1)
+    options.update(getattr(request, 'param', {}))
+    return GitHubDataSource.objects.create(**options)
+
+
+@pytest.mark.django_db
+@pytest.fixture
+def trello_data_source():
+    return TrelloDataSource.objects.create(name='Trello', organization='org', key='key', token='token')
+
+
+@pytest.fixture
+def github_fake(request):
+    """
+    Fake GitHub API serving the requests of the test
+
+    The options for generating the data can be changed with indirect
+    parametrization.
+    """
+    options = dict(repos=1, issues=100)
+    options.update(getattr(request, 'param', {}))
+    with FakeGitHub.generate('org', **options).installed() as fake:
+        yield fake
+
+
+@pytest.fixture
+def trello_fake(request):
+    """
+    Fake Trello API serving the requests of the test
+
+    The options for generating the data can be changed with indirect
+    parametrization.
+    """
+    options = dict(boards=1, lists=3, cards=50, members=5)
+    options.update(getattr(request, 'param', {}))
+    with FakeTrello.generate('org', **options).installed() as fake:
+        yield fake
+
+
+@pytest.mark.django_db
+@pytest.fixture
+def synced_repo(github_data_source, github_fake):
+    github_data_source.sync_workspaces()
+    return github_data_source.workspaces.get(origin_id='100')
+
+
+@pytest.mark.django_db
+@pytest.fixture
+def synced_board(trello_data_source, trello_fake):
+    trello_data_source.sync_workspaces()
+    return trello_data_source.workspaces.get(origin_id='board0')
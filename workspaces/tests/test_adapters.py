@@ -0,0 +1,604 @@
+import pytest
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from workspaces.adapters.base import Adapter, TaskSyncContext
+from workspaces.adapters.fake import FakeTrello
+from workspaces.adapters.github import handle_github_event
+from workspaces.adapters.ratelimit import RateLimiter, RateLimitExceeded
+from workspaces.adapters.trello import TrelloAdapter
+from workspaces.models import (
+    DataSourceUser, RateLimitBucket, SyncRun, Task, TaskAssignment, Workspace, WorkspaceList
+)
+
+
+def make_tasks():
+    return [
+        dict(origin_id='t1', name='Task 1', state='open', assigned_users=['dsu1']),
+        dict(origin_id='t2', name='Task 2', state='open', assigned_users=[]),
+    ]
+
+
+@pytest.mark.django_db
+def test_update_tasks(workspace, data_source_user):
+    adapter = Adapter(workspace.data_source)
+    tasks = make_tasks()
+    adapter._update_tasks(workspace, tasks)
+    assert workspace.tasks.count() == 2
+    t1 = workspace.tasks.get(origin_id='t1')
+    assert [a.user for a in t1.assignments.all()] == [data_source_user]
+
+    tasks[0]['assigned_users'] = []
+    tasks[1]['name'] = 'Renamed'
+    adapter._update_tasks(workspace, tasks)
+    assert TaskAssignment.objects.count() == 0
+    assert workspace.tasks.get(origin_id='t2').name == 'Renamed'
+    assert workspace.tasks.get(origin_id='t1').id == t1.id
+
+    adapter._update_tasks(workspace, tasks[1:])
+    assert workspace.tasks.get(origin_id='t1').state == Task.STATE_CLOSED
+    assert workspace.tasks.get(origin_id='t2').state == Task.STATE_OPEN
+
+
+@pytest.mark.django_db
+def test_trello_apply_action(workspace, task):
+    adapter = TrelloAdapter(workspace.data_source)
+    action = dict(type='updateCard', date='2018-01-18T11:50:00.000Z',
+                  data=dict(card=dict(id='task1', name='Renamed', closed=True)))
+    assert adapter.apply_action(workspace, action)
+    task.refresh_from_db()
+    assert task.name == 'Renamed'
+    assert task.state == Task.STATE_CLOSED
+
+    action = dict(type='moveCardToBoard', date='2018-01-18T11:51:00.000Z',
+                  data=dict(card=dict(id='task1', name='Renamed')))
+    assert not adapter.apply_action(workspace, action)
+
+
+@pytest.mark.django_db
+def test_trello_apply_action_ignores_outdated(workspace, task):
+    adapter = TrelloAdapter(workspace.data_source)
+    action = dict(type='updateCard', date='2018-01-18T11:51:00.000Z',
+                  data=dict(card=dict(id='task1', name='Renamed', closed=True)))
+    assert adapter.apply_action(workspace, action)
+
+    action = dict(type='updateCard', date='2018-01-18T11:50:00.000Z',
+                  data=dict(card=dict(id='task1', name='Old name', closed=False)))
+    assert adapter.apply_action(workspace, action)
+    task.refresh_from_db()
+    assert task.name == 'Renamed'
+    assert task.state == Task.STATE_CLOSED
+
+
+@pytest.mark.django_db
+def test_trello_apply_member_action_without_full_name(workspace, task):
+    adapter = TrelloAdapter(workspace.data_source)
+    action = dict(type='addMemberToCard', date='2018-01-18T11:50:00.000Z',
+                  member=dict(id='member1', username='member'),
+                  data=dict(card=dict(id='task1')))
+    assert adapter.apply_action(workspace, action)
+    assert [u.origin_id for u in task.assigned_users.all()] == ['member1']
+
+    action['type'] = 'removeMemberFromCard'
+    assert adapter.apply_action(workspace, action)
+    assert not task.assigned_users.exists()
+
+
+@pytest.mark.django_db
+def test_update_workspace_lists_applies_state_to_existing(workspace):
+    adapter = Adapter(workspace.data_source)
+    lists = [dict(origin_id='l1', name='List 1', position=1, state='open')]
+    adapter._update_workspace_lists(workspace, lists)
+    assert workspace.lists.get(origin_id='l1').state == WorkspaceList.STATE_OPEN
+
+    lists[0]['state'] = 'closed'
+    adapter._update_workspace_lists(workspace, lists)
+    assert workspace.lists.get(origin_id='l1').state == WorkspaceList.STATE_CLOSED
+
+    # Partial list dicts from webhooks leave the state as it is
+    adapter._update_workspace_lists(workspace, [dict(origin_id='l1', name='Renamed')], skip_delete=True)
+    lst = workspace.lists.get(origin_id='l1')
+    assert lst.name == 'Renamed'
+    assert lst.state == WorkspaceList.STATE_CLOSED
+
+    lists[0]['state'] = 'open'
+    adapter._update_workspace_lists(workspace, lists)
+    assert workspace.lists.get(origin_id='l1').state == WorkspaceList.STATE_OPEN
+
+
+def make_issue_event(action, **changes):
+    issue = dict(number=7, title='Issue 7', state='open', assignees=[dict(id=42, login='octocat')],
+                 created_at='2018-01-18T11:50:00Z', updated_at='2018-01-18T11:50:00Z', closed_at=None)
+    issue.update(changes)
+    return dict(action=action, issue=issue, repository=dict(id=100, name='repo'),
+                organization=dict(login='org'))
+
+
+@pytest.mark.django_db
+def test_github_issue_events(github_data_source):
+    workspace = github_data_source.workspaces.create(name='repo', origin_id='100')
+
+    handle_github_event('issues', make_issue_event('opened'))
+    task = workspace.tasks.get(origin_id='7')
+    assert task.name == 'Issue 7'
+    assert task.state == Task.STATE_OPEN
+    assert [u.username for u in task.assigned_users.all()] == ['octocat']
+
+    handle_github_event('issues', make_issue_event('edited', title='Renamed', assignees=[],
+                                                   updated_at='2018-01-18T11:51:00Z'))
+    task.refresh_from_db()
+    assert task.name == 'Renamed'
+    assert not task.assigned_users.exists()
+
+    handle_github_event('issues', make_issue_event('closed', state='closed', closed_at='2018-01-18T11:52:00Z',
+                                                   updated_at='2018-01-18T11:52:00Z'))
+    task.refresh_from_db()
+    assert task.state == Task.STATE_CLOSED
+
+    handle_github_event('issues', make_issue_event('reopened', updated_at='2018-01-18T11:53:00Z'))
+    task.refresh_from_db()
+    assert task.state == Task.STATE_OPEN
+
+    # The payload of a deleted issue still shows it open
+    handle_github_event('issues', make_issue_event('deleted', updated_at='2018-01-18T11:53:00Z'))
+    task.refresh_from_db()
+    assert task.state == Task.STATE_CLOSED
+    assert workspace.tasks.count() == 1
+
+
+@pytest.mark.django_db
+def test_github_issue_events_out_of_order(github_data_source):
+    workspace = github_data_source.workspaces.create(name='repo', origin_id='100')
+
+    handle_github_event('issues', make_issue_event('closed', state='closed', closed_at='2018-01-18T11:52:00Z',
+                                                   updated_at='2018-01-18T11:52:00Z'))
+    handle_github_event('issues', make_issue_event('edited', title='Renamed', updated_at='2018-01-18T11:51:00Z'))
+    task = workspace.tasks.get(origin_id='7')
+    assert task.state == Task.STATE_CLOSED
+    assert task.name == 'Issue 7'
+
+
+@pytest.mark.django_db
+def test_github_repository_events(github_data_source):
+    event = dict(action='created', repository=dict(id=100, name='repo', description='Repository'),
+                 organization=dict(login='org'))
+
+    handle_github_event('repository', event)
+    workspace = github_data_source.workspaces.get(origin_id='100')
+    assert workspace.name == 'repo'
+    assert workspace.state == Workspace.STATE_OPEN
+
+    event['repository']['name'] = 'renamed'
+    handle_github_event('repository', dict(event, action='renamed'))
+    workspace.refresh_from_db()
+    assert workspace.name == 'renamed'
+
+    event['repository']['archived'] = True
+    handle_github_event('repository', dict(event, action='archived'))
+    workspace.refresh_from_db()
+    assert workspace.state == Workspace.STATE_CLOSED
+
+    event['repository']['archived'] = False
+    handle_github_event('repository', dict(event, action='unarchived'))
+    workspace.refresh_from_db()
+    assert workspace.state == Workspace.STATE_OPEN
+
+    handle_github_event('repository', dict(event, action='deleted'))
+    workspace.refresh_from_db()
+    assert workspace.state == Workspace.STATE_CLOSED
+    assert github_data_source.workspaces.count() == 1
+
+
+@pytest.mark.django_db
+def test_update_tasks_skips_unchanged(workspace):
+    adapter = Adapter(workspace.data_source)
+    tasks = [dict(origin_id='t1', name='Task 1', state='open', assigned_users=[],
+                  updated_at='2018-01-18T11:50:00Z')]
+    assert adapter._update_tasks(workspace, tasks)['created'] == 1
+
+    stats = adapter._update_tasks(workspace, tasks)
+    assert stats['created'] == 0
+    assert stats['updated'] == 0
+
+
+@pytest.mark.django_db
+def test_update_tasks_assigns_users_saved_later(workspace, data_source_user, user2):
+    tasks = make_tasks()
+    tasks[0]['assigned_users'] = ['dsu1', 'dsu2']
+    Adapter(workspace.data_source)._update_tasks(workspace, tasks)
+    t1 = workspace.tasks.get(origin_id='t1')
+    assert [a.user for a in t1.assignments.all()] == [data_source_user]
+    assert t1.fingerprint is None
+
+    dsu2 = DataSourceUser.objects.create(data_source=workspace.data_source, user=user2, origin_id='dsu2')
+    Adapter(workspace.data_source)._update_tasks(workspace, tasks)
+    t1.refresh_from_db()
+    assert set(a.user for a in t1.assignments.all()) == {data_source_user, dsu2}
+    assert t1.fingerprint is not None
+
+
+@pytest.mark.django_db
+def test_update_tasks_removes_assignments_created_with_same_context(workspace, data_source_user):
+    adapter = Adapter(workspace.data_source)
+    context = TaskSyncContext(workspace, adapter.user_cache)
+    tasks = make_tasks()
+    adapter._update_tasks(workspace, tasks, context=context)
+    assert TaskAssignment.objects.count() == 1
+
+    tasks[0]['assigned_users'] = []
+    adapter._update_tasks(workspace, tasks, context=context)
+    assert TaskAssignment.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_update_single_task_loads_only_that_task(workspace, data_source_user):
+    adapter = Adapter(workspace.data_source)
+    adapter._update_tasks(workspace, [dict(origin_id='t%d' % i, name='Task %d' % i, state='open',
+                                           assigned_users=['dsu1']) for i in range(20)])
+    with CaptureQueriesContext(connection) as ctx:
+        adapter._update_tasks(workspace, dict(origin_id='t1', name='Renamed'))
+    assert workspace.tasks.get(origin_id='t1').name == 'Renamed'
+    assert workspace.tasks.get(origin_id='t2').name == 'Task 2'
+    assert [a.user for a in workspace.tasks.get(origin_id='t1').assignments.all()] == [data_source_user]
+    workspace_queries = [q['sql'] for q in ctx.captured_queries
+                         if '"workspaces_task"."workspace_id" =' in q['sql']]
+    assert workspace_queries
+    assert all("'t1'" in sql for sql in workspace_queries)
+
+
+def count_update_queries(workspace, count):
+    adapter = Adapter(workspace.data_source)
+    tasks = [dict(origin_id='t%d' % i, name='Task %d' % i, state='open', assigned_users=['dsu1', 'dsu2'])
+             for i in range(count)]
+    with CaptureQueriesContext(connection) as ctx:
+        adapter._update_tasks(workspace, tasks)
+    for task in tasks:
+        task['name'] += ' renamed'
+        task['assigned_users'] = ['dsu2']
+    with CaptureQueriesContext(connection) as ctx2:
+        adapter._update_tasks(workspace, tasks)
+    return len(ctx.captured_queries), len(ctx2.captured_queries)
+
+
+@pytest.mark.django_db
+def test_update_tasks_query_count(workspace, data_source_user, user2):
+    DataSourceUser.objects.create(data_source=workspace.data_source, user=user2, origin_id='dsu2')
+    few = count_update_queries(workspace, 2)
+    workspace.tasks.all().delete()
+    many = count_update_queries(workspace, 50)
+    assert few == many
+
+
+@pytest.mark.django_db
+def test_save_users_writes_only_changes(data_source):
+    adapter = Adapter(data_source)
+    users = [dict(origin_id='u1', username='one'), dict(origin_id='u2', username='two')]
+    adapter.save_users(users)
+    assert data_source.data_source_users.count() == 2
+
+    with CaptureQueriesContext(connection) as ctx:
+        adapter.save_users(users)
+    assert len(ctx.captured_queries) == 0
+
+    users[0]['username'] = 'renamed'
+    adapter.save_users(users)
+    assert data_source.data_source_users.get(origin_id='u1').username == 'renamed'
+
+
+def make_workspaces():
+    lists = [dict(origin_id='l1', name='To do', position=1.0, state='open'),
+             dict(origin_id='l2', name='Done', position=2.0, state='open')]
+    return [dict(origin_id='ws2', name='Board', description=None, state='open', lists=lists)]
+
+
+@pytest.mark.django_db
+def test_update_workspaces_writes_only_changes(data_source):
+    adapter = Adapter(data_source)
+    adapter._update_workspaces(make_workspaces())
+    ws = data_source.workspaces.get(origin_id='ws2')
+    assert ws.lists.open().count() == 2
+
+    with CaptureQueriesContext(connection) as ctx:
+        adapter._update_workspaces(make_workspaces())
+    writes = [q for q in ctx.captured_queries if q['sql'].startswith(('INSERT', 'UPDATE'))]
+    assert writes == []
+
+    workspaces = make_workspaces()
+    workspaces[0]['lists'] = workspaces[0]['lists'][:1]
+    adapter._update_workspaces(workspaces)
+    assert ws.lists.get(origin_id='l2').state == 'closed'
+
+
+@pytest.mark.django_db
+def test_update_workspaces_reopens_closed(data_source):
+    adapter = Adapter(data_source)
+    adapter._update_workspaces(make_workspaces())
+    workspaces = make_workspaces()
+    workspaces[0]['lists'] = workspaces[0]['lists'][:1]
+    adapter._update_workspaces(workspaces)
+    adapter._update_workspaces([])
+    ws = data_source.workspaces.get(origin_id='ws2')
+    assert ws.state == 'closed'
+
+    # Rows that come back unchanged are opened again
+    adapter._update_workspaces(make_workspaces())
+    ws.refresh_from_db()
+    assert ws.state == 'open'
+    assert ws.lists.open().count() == 2
+
+
+@pytest.mark.django_db
+def test_update_tasks_reopens_closed(workspace, data_source_user):
+    adapter = Adapter(workspace.data_source)
+    adapter._update_tasks(workspace, make_tasks())
+    adapter._update_tasks(workspace, make_tasks()[1:])
+    assert workspace.tasks.get(origin_id='t1').state == Task.STATE_CLOSED
+
+    adapter._update_tasks(workspace, make_tasks())
+    assert workspace.tasks.get(origin_id='t1').state == Task.STATE_OPEN
+
+
+@pytest.mark.django_db
+def test_update_tasks_collects_metrics(workspace, data_source_user):
+    adapter = Adapter(workspace.data_source)
+    with adapter.metrics.count_queries():
+        adapter._update_tasks(workspace, make_tasks())
+    assert adapter.metrics.sql_queries > 0
+    assert adapter.metrics.timings['write'] > 0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('github_data_source', [dict(fetch_workers=2)], indirect=True)
+def test_github_sync_tasks_with_fake_api(github_fake, synced_repo):
+    assert synced_repo.sync_tasks()['created'] == 100
+
+    github_fake.update_issue('org/repo0', 1, title='Renamed')
+    stats = synced_repo.sync_tasks()
+    assert stats['updated'] == 1
+    assert synced_repo.tasks.get(origin_id='1').name == 'Renamed'
+    assert synced_repo.sync_runs.count() == 2
+    assert all(run.sql_queries > 0 for run in synced_repo.sync_runs.all())
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('github_fake', [dict(issues=250)], indirect=True)
+def test_github_full_sync_reuses_unchanged_pages(monkeypatch, github_data_source, github_fake, synced_repo):
+    statuses = []
+    build_response = github_fake.build_response
+
+    def record_status(request, status, content, headers):
+        statuses.append(status)
+        return build_response(request, status, content, headers)
+    monkeypatch.setattr(github_fake, 'build_response', record_status)
+
+    assert synced_repo.sync_tasks(full=True)['created'] == 250
+    entries = github_data_source.http_cache_entries.count()
+    assert entries > 1
+
+    github_fake.update_issue('org/repo0', 1, title='Renamed')
+    del statuses[:]
+    stats = synced_repo.sync_tasks(full=True)
+    assert 304 in statuses
+    assert stats['updated'] == 1
+    assert stats['closed'] == 0
+    assert synced_repo.tasks.get(origin_id='1').name == 'Renamed'
+    assert synced_repo.tasks.count() == 250
+
+    # Requests for changes since the previous sync are never cached
+    synced_repo.sync_tasks()
+    assert github_data_source.http_cache_entries.count() == entries
+    assert not github_data_source.http_cache_entries.filter(url__contains='since').exists()
+
+
+@pytest.mark.django_db
+@override_settings(SYNC_RATE_LIMIT_MAX_WAIT=0)
+def test_rate_limiter_shares_bucket():
+    limiter = RateLimiter('credential', 2, 10)
+    limiter.acquire()
+    limiter.acquire()
+    with pytest.raises(RateLimitExceeded):
+        RateLimiter('credential', 2, 10).acquire()
+    RateLimiter('other credential', 2, 10).acquire()
+
+
+@pytest.mark.django_db
+@override_settings(SYNC_RATE_LIMIT_BATCH_SIZE=5)
+def test_rate_limiter_reserves_tokens_in_batches():
+    limiter = RateLimiter('credential', 100, 10)
+    limiter.acquire()
+    with CaptureQueriesContext(connection) as ctx:
+        for i in range(4):
+            limiter.acquire()
+    assert len(ctx.captured_queries) == 0
+    assert RateLimitBucket.objects.get().tokens == 95
+
+    with CaptureQueriesContext(connection) as ctx:
+        limiter.acquire()
+    assert len(ctx.captured_queries) > 0
+
+
+@pytest.mark.django_db
+@override_settings(SYNC_HTTP_RETRIES=1, SYNC_HTTP_RETRY_DELAY=0)
+def test_github_sync_tasks_resumes_after_failure(github_fake, synced_repo):
+    # A single failure is retried
+    github_fake.fail('page=2')
+    github_fake.fail('page=3', count=2)
+    with pytest.raises(AssertionError):
+        synced_repo.sync_tasks()
+    synced_repo.refresh_from_db()
+    assert synced_repo.sync_checkpoint['url'].endswith('page=3')
+
+    del github_fake.requests[:]
+    stats = synced_repo.sync_tasks()
+    assert [url for method, url in github_fake.requests if '/issues' in url][0].endswith('page=3')
+    assert stats['created'] == 40
+    assert synced_repo.tasks.count() == 100
+    synced_repo.refresh_from_db()
+    assert synced_repo.sync_checkpoint is None
+
+
+@pytest.mark.django_db
+@override_settings(SYNC_HTTP_RETRIES=0)
+def test_github_full_sync_ignores_checkpoint(github_fake, synced_repo):
+    synced_repo.tasks.create(origin_id='999', name='Removed', state='open')
+    github_fake.fail('page=3')
+    with pytest.raises(AssertionError):
+        synced_repo.sync_tasks()
+    synced_repo.refresh_from_db()
+    assert synced_repo.sync_checkpoint
+
+    stats = synced_repo.sync_tasks(full=True)
+    assert stats['closed'] == 1
+    assert synced_repo.tasks.get(origin_id='999').state == Task.STATE_CLOSED
+    synced_repo.refresh_from_db()
+    assert synced_repo.sync_checkpoint is None
+
+
+@pytest.mark.django_db
+def test_trello_full_sync_uses_board_snapshot(trello_data_source, trello_fake, synced_board):
+    del trello_fake.requests[:]
+    stats = synced_board.sync_tasks(full=True)
+    assert len(trello_fake.requests) == 1
+    assert stats['created'] == 50
+    assert synced_board.tasks.filter(list__isnull=True).count() == 0
+    assert trello_data_source.data_source_users.count() == 5
+
+
+@pytest.mark.django_db
+def test_trello_full_sync_keeps_former_members_assigned(trello_data_source, trello_fake):
+    card = trello_fake.state['boards']['board0']['cards'][0]
+    card['idMembers'] = ['member0']
+    trello_fake.remove_member('board0', 'member0')
+    trello_data_source.sync_workspaces()
+    workspace = trello_data_source.workspaces.get(origin_id='board0')
+    workspace.sync_tasks(full=True)
+    task = workspace.tasks.get(origin_id=card['id'])
+    assert [u.origin_id for u in task.assigned_users.all()] == ['member0']
+
+    # Known users are not fetched again
+    del trello_fake.requests[:]
+    workspace.sync_tasks(full=True)
+    assert len(trello_fake.requests) == 1
+    assert [u.origin_id for u in task.assigned_users.all()] == ['member0']
+
+
+@pytest.mark.django_db
+def test_trello_sync_selected_tasks_uses_batch_api(trello_fake, synced_board):
+    del trello_fake.requests[:]
+    card_ids = ['board0-card%d' % i for i in range(12)] + ['missing']
+    stats = synced_board.sync_selected_tasks(card_ids)
+    assert len(trello_fake.requests) == 2
+    assert stats['created'] == 12
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('github_fake', [dict(issues=50, closed=0)], indirect=True)
+def test_github_incremental_sync_fetches_changed_issues(github_fake, synced_repo):
+    synced_repo.sync_tasks()
+    synced_repo.refresh_from_db()
+    synced_at = synced_repo.tasks_synced_at
+
+    github_fake.update_issue('org/repo0', 1, title='Renamed')
+    github_fake.state['issues']['org/repo0'].pop()
+    del github_fake.requests[:]
+    stats = synced_repo.sync_tasks()
+    assert [url for method, url in github_fake.requests if 'since=' not in url] == []
+    assert stats['updated'] == 1
+    # Only full syncs close tasks missing from GitHub
+    assert stats['closed'] == 0
+    synced_repo.refresh_from_db()
+    assert synced_repo.tasks_synced_at > synced_at
+
+    stats = synced_repo.sync_tasks(full=True)
+    assert stats['closed'] == 1
+    assert synced_repo.tasks.get(origin_id='50').state == Task.STATE_CLOSED
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('trello_fake', [dict(cards=30, closed=0)], indirect=True)
+def test_trello_incremental_sync_fetches_changed_cards(trello_fake, synced_board):
+    synced_board.sync_tasks()
+    synced_board.refresh_from_db()
+    synced_at = synced_board.tasks_synced_at
+
+    board = trello_fake.state['boards']['board0']
+    trello_fake.update_card('board0', 'board0-card1', name='Renamed')
+    trello_fake.update_card('board0', 'board0-card2', name='Deleted')
+    board['cards'] = [c for c in board['cards'] if c['id'] not in ('board0-card2', 'board0-card3')]
+    del trello_fake.requests[:]
+    stats = synced_board.sync_tasks()
+    assert [url for method, url in trello_fake.requests if 'boards/board0/cards' in url] == []
+    assert stats['updated'] == 2
+    assert synced_board.tasks.get(origin_id='board0-card1').name == 'Renamed'
+    # Deleted cards are closed, but cards missing without activity are
+    # left for full syncs.
+    assert synced_board.tasks.get(origin_id='board0-card2').state == Task.STATE_CLOSED
+    assert synced_board.tasks.get(origin_id='board0-card3').state == Task.STATE_OPEN
+    synced_board.refresh_from_db()
+    assert synced_board.tasks_synced_at > synced_at
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('trello_fake', [dict(cards=30, closed=0)], indirect=True)
+def test_trello_incremental_sync_falls_back_to_board_cards(monkeypatch, trello_fake, synced_board):
+    monkeypatch.setattr('workspaces.adapters.trello.MAX_INCREMENTAL_CARDS', 1)
+    synced_board.sync_tasks()
+
+    trello_fake.update_card('board0', 'board0-card1', name='Renamed')
+    trello_fake.update_card('board0', 'board0-card2', closed=True)
+    del trello_fake.requests[:]
+    stats = synced_board.sync_tasks()
+    assert len([url for method, url in trello_fake.requests if 'boards/board0/cards' in url]) == 1
+    assert stats['created'] == 0
+    assert stats['updated'] == 2
+    assert synced_board.tasks.get(origin_id='board0-card2').state == Task.STATE_CLOSED
+
+
+@pytest.mark.django_db
+def test_trello_sync_task_closes_deleted_card(trello_data_source):
+    workspace = trello_data_source.workspaces.create(name='Board', origin_id='board0')
+    task = workspace.tasks.create(name='Card', origin_id='card0', state=Task.STATE_OPEN)
+    with FakeTrello().installed():
+        assert workspace.sync_task('card0')['updated'] == 1
+    task.refresh_from_db()
+    assert task.state == Task.STATE_CLOSED
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('github_data_source', [dict(token='token')], indirect=True)
+@pytest.mark.parametrize('github_fake', [dict(repos=3, issues=10)], indirect=True)
+def test_github_sync_all_tasks_streams_organization_issues(github_data_source, github_fake):
+    github_data_source.sync_workspaces()
+    github_data_source.workspaces.update(sync=True)
+    assert github_data_source.sync_tasks()['created'] == 30
+
+    github_fake.update_issue('org/repo1', 1, title='Renamed')
+    github_fake.update_issue('org/repo2', 2, title='Renamed')
+    del github_fake.requests[:]
+    started_at = timezone.now()
+    stats = github_data_source.sync_tasks()
+    assert stats['updated'] == 2
+    assert [url for method, url in github_fake.requests if '/orgs/org/issues' not in url] == []
+    assert github_data_source.workspaces.get(origin_id='101').tasks.get(origin_id='1').name == 'Renamed'
+
+    runs = SyncRun.objects.filter(started_at__gte=started_at)
+    assert sorted(run.workspace.origin_id for run in runs) == ['100', '101', '102']
+    assert sum(run.tasks_updated for run in runs) == 2
+    assert sum(run.http_requests for run in runs) > 0
+    assert all(run.finished_at and run.error is None for run in runs)
+    assert all(ws.tasks_synced_at >= started_at for ws in github_data_source.workspaces.all())
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('github_fake', [dict(repos=2, issues=10)], indirect=True)
+def test_github_sync_all_tasks_without_token_syncs_repos(github_data_source, github_fake):
+    github_data_source.sync_workspaces()
+    github_data_source.workspaces.update(sync=True)
+    github_data_source.sync_tasks()
+
+    github_fake.update_issue('org/repo1', 1, title='Renamed')
+    del github_fake.requests[:]
+    stats = github_data_source.sync_tasks()
+    assert stats['updated'] == 1
+    assert [url for method, url in github_fake.requests if '/orgs/org/issues' in url] == []
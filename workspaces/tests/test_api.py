@@ -0,0 +1,26 @@
+import pytest
+from django.urls import reverse
+from django.utils import timezone
+
+from workspaces.models import SyncRun
+
+
+SYNC_RUN_LIST_URL = reverse('v1:syncrun-list')
+
+
+@pytest.fixture
+def sync_run(workspace):
+    return SyncRun.objects.create(data_source=workspace.data_source, workspace=workspace,
+                                  started_at=timezone.now())
+
+
+@pytest.mark.django_db
+def test_api_sync_runs_are_staff_only(api_client, user_api_client, user, sync_run):
+    assert api_client.get(SYNC_RUN_LIST_URL).status_code in (401, 403)
+    assert user_api_client.get(SYNC_RUN_LIST_URL).status_code == 403
+
+    user.is_staff = True
+    user.save()
+    response = user_api_client.get(SYNC_RUN_LIST_URL)
+    assert response.status_code == 200
+    assert [run['id'] for run in response.data['sync_run']] == [sync_run.id]
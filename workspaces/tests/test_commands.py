@@ -0,0 +1,127 @@
+import datetime
+import threading
+import time
+from collections import Counter
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.db import OperationalError
+from django.test import override_settings
+from django.utils import timezone
+from workspaces.management.commands import run_sync_worker, sync_workspaces
+from workspaces.models import DataSource, HTTPCacheEntry, SyncJob
+
+
+class FakeSync(object):
+    """
+    Stand-in for syncing a workspace, recording which workspaces were being
+    synced whenever a sync started
+    """
+    def __init__(self, duration):
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.running = set()
+        self.started = []
+        self.calls = []
+
+    def __call__(self, item_id, full):
+        with self.lock:
+            self.running.add(item_id)
+            self.calls.append(item_id)
+            self.started.append(set(self.running))
+        time.sleep(self.duration)
+        with self.lock:
+            self.running.discard(item_id)
+        return self.duration, Counter(updated=1), None
+
+
+def create_workspaces(data_source, count):
+    return [data_source.workspaces.create(name='ws%d' % i, origin_id='ws%d' % i, sync=True)
+            for i in range(count)]
+
+
+@pytest.mark.django_db
+def test_sync_workspaces_limits_syncs_per_source(monkeypatch):
+    fake = FakeSync(0.05)
+    monkeypatch.setattr(sync_workspaces, 'sync_workspace', fake)
+    source_of = {}
+    for i in range(2):
+        data_source = DataSource.objects.create(type='test', name='Source %d' % i)
+        for ws in create_workspaces(data_source, 3):
+            source_of[ws.id] = data_source.id
+
+    out = StringIO()
+    call_command('sync_workspaces', workers=4, max_per_source=1, stdout=out)
+    assert len(fake.calls) == 6
+    for running in fake.started:
+        sources = [source_of[ws_id] for ws_id in running]
+        assert len(sources) == len(set(sources))
+    assert 'Synced 6 workspaces' in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_sync_workspaces_stops_starting_syncs_after_budget(monkeypatch, data_source):
+    fake = FakeSync(0.2)
+    monkeypatch.setattr(sync_workspaces, 'sync_workspace', fake)
+    create_workspaces(data_source, 3)
+
+    out = StringIO()
+    call_command('sync_workspaces', workers=1, budget=0.1, stdout=out)
+    assert len(fake.calls) == 1
+    assert out.getvalue().count('skipped, time budget exceeded') == 2
+    assert '(0 failed, 2 skipped)' in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_sync_workspaces_by_source(monkeypatch):
+    fake = FakeSync(0)
+    monkeypatch.setattr(sync_workspaces, 'sync_data_source', fake)
+    data_sources = [DataSource.objects.create(type='test', name='Source %d' % i) for i in range(2)]
+    for data_source in data_sources:
+        create_workspaces(data_source, 2)
+
+    out = StringIO()
+    call_command('sync_workspaces', by_source=True, stdout=out)
+    assert sorted(fake.calls) == [ds.id for ds in data_sources]
+    assert 'Synced 2 data sources' in out.getvalue()
+
+    with pytest.raises(CommandError):
+        call_command('sync_workspaces', by_source=True, max_per_source=1, stdout=out)
+
+
+@pytest.mark.django_db
+@override_settings(SYNC_HTTP_CACHE_MAX_AGE=3600)
+def test_sync_workspaces_prunes_http_cache(monkeypatch, data_source):
+    monkeypatch.setattr(sync_workspaces, 'sync_workspace', FakeSync(0))
+    create_workspaces(data_source, 1)
+    for key in ('old', 'new'):
+        data_source.http_cache_entries.create(key=key, url='https://example.com/%s' % key)
+    data_source.http_cache_entries.filter(key='old').update(updated_at=timezone.now() - datetime.timedelta(hours=2))
+
+    call_command('sync_workspaces', stdout=StringIO())
+    assert list(HTTPCacheEntry.objects.values_list('key', flat=True)) == ['new']
+
+
+# The worker closes connections left in a transaction
+@pytest.mark.django_db(transaction=True)
+def test_run_sync_worker_survives_database_errors(monkeypatch):
+    claim = SyncJob.claim
+    failures = [OperationalError('server closed the connection unexpectedly')]
+
+    def flaky_claim():
+        if failures:
+            raise failures.pop()
+        return claim()
+    monkeypatch.setattr(SyncJob, 'claim', flaky_claim)
+
+    call_command('run_sync_worker', burst=True, interval=0, stdout=StringIO())
+    assert not failures
+
+
+@pytest.mark.django_db(transaction=True)
+def test_run_sync_worker_closes_sessions(monkeypatch):
+    closed = []
+    monkeypatch.setattr(run_sync_worker, 'close_sessions', lambda: closed.append(True))
+    call_command('run_sync_worker', burst=True, interval=0, stdout=StringIO())
+    assert closed
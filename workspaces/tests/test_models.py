@@ -1,7 +1,72 @@
+import datetime
+
 import pytest
-from workspaces.models import Task
+from django.test import override_settings
+from django.utils import timezone
+from workspaces.models import SyncJob, SyncRun, Task
 
 
 @pytest.mark.django_db
 def test_create_task(task):
     assert Task.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_schedule_task_sync_enqueues_job(workspace):
+    job = workspace.schedule_task_sync('task1')
+    assert job.state == SyncJob.STATE_PENDING
+    assert job.data_source == workspace.data_source
+    SyncJob.objects.filter(id=job.id).update(run_after=timezone.now())
+
+    claimed = SyncJob.claim()
+    assert claimed.id == job.id
+    assert claimed.state == SyncJob.STATE_RUNNING
+    assert claimed.attempts == 1
+    assert SyncJob.claim() is None
+
+
+@pytest.mark.django_db
+@override_settings(SYNC_JOB_ESCALATE_THRESHOLD=3)
+def test_schedule_task_sync_coalesces(workspace):
+    job = workspace.schedule_task_sync('task1')
+    assert workspace.schedule_task_sync('task1') == job
+    workspace.schedule_task_sync('task2')
+    assert SyncJob.objects.count() == 2
+
+    job = workspace.schedule_task_sync('task3')
+    assert job.type == SyncJob.TYPE_TASKS
+    assert list(SyncJob.objects.all()) == [job]
+    assert workspace.schedule_task_sync('task4') == job
+
+
+@pytest.mark.django_db
+def test_claim_merges_task_syncs_of_workspace(workspace):
+    workspace.schedule_task_sync('task1')
+    workspace.schedule_task_sync('task2')
+    SyncJob.objects.update(run_after=timezone.now())
+
+    claimed = SyncJob.claim()
+    assert [job.task_origin_id for job in claimed.merged_jobs] == ['task2']
+    assert SyncJob.objects.filter(state=SyncJob.STATE_RUNNING).count() == 2
+    assert SyncJob.claim() is None
+
+
+@pytest.mark.django_db
+@override_settings(SYNC_JOB_RETENTION=3600)
+def test_prune_deletes_old_finished_jobs(workspace):
+    old = timezone.now() - datetime.timedelta(hours=2)
+    done = workspace.schedule_task_sync('task1')
+    SyncJob.objects.filter(id=done.id).update(state=SyncJob.STATE_DONE, finished_at=old)
+    recent = SyncJob.objects.create(type=SyncJob.TYPE_TASKS, data_source=workspace.data_source,
+                                    workspace=workspace, state=SyncJob.STATE_DONE, finished_at=timezone.now())
+    failed = SyncJob.objects.create(type=SyncJob.TYPE_TASKS, data_source=workspace.data_source,
+                                    workspace=workspace, state=SyncJob.STATE_FAILED, finished_at=old)
+
+    assert SyncJob.prune() == 1
+    assert set(SyncJob.objects.values_list('id', flat=True)) == {recent.id, failed.id}
+
+
+def test_sync_run_error_leaves_out_query_strings():
+    run = SyncRun()
+    run.set_error(ConnectionError("Max retries exceeded with url: /1/boards/b1/cards?key=k&token=t (Caused by x)"))
+    assert run.error == "ConnectionError: Max retries exceeded with url: /1/boards/b1/cards (Caused by x)"